@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+import reports
+
+logger = logging.getLogger(__name__)
+
+# Segundos durante los que el espejo local se considera actualizado
+MAX_AGE = float(os.environ.get('ATTENDANCE_CACHE_MAX_AGE', 60))
+# Registros que se conservan por empleado (los más recientes por id)
+KEEP_RECORDS = 20
+
+# Espejo por (url, db, employee_id): registros por id y hora de sincronización
+_mirror = {}
+_lock = threading.Lock()
+
+def _key(url, db, employee_id):
+    return (url.rstrip('/'), db, employee_id)
+
+def _trim(records):
+    if len(records) > KEEP_RECORDS:
+        for attendance_id in sorted(records)[:-KEEP_RECORDS]:
+            del records[attendance_id]
+
+def record(url, db, employee_id, attendance):
+    """Aplicar al espejo un cambio hecho por el propio bot (entrada o salida)"""
+    with _lock:
+        entry = _mirror.get(_key(url, db, employee_id))
+        if entry is None:
+            return
+        current = entry['records'].setdefault(attendance['id'], {'id': attendance['id']})
+        current.update(attendance)
+        # Para no perder el cambio si una sincronización en curso reemplaza el espejo
+        entry['recorded'][attendance['id']] = time.monotonic()
+        _trim(entry['records'])
+
+def invalidate(url, db, employee_id=None):
+    """Descartar el espejo de un empleado (o de toda la base de datos)"""
+    with _lock:
+        for key in [k for k in _mirror if k[:2] == (url.rstrip('/'), db)
+                    and (employee_id is None or k[2] == employee_id)]:
+            del _mirror[key]
+
+def sync(odoo, employee_id):
+    """Reemplazar el espejo con las últimas asistencias del empleado
+
+    Una sola llamada (get_attendance_status, ordenada y limitada en el servidor) que
+    también descarta los registros borrados en Odoo. Devuelve el resumen, o None si falla.
+    """
+    key = _key(odoo.url, odoo.db, employee_id)
+    started = time.monotonic()
+    status = odoo.get_attendance_status(employee_id, limit=KEEP_RECORDS)
+    if status is None:
+        return None
+    records = {attendance['id']: attendance for attendance in status.pop('records')}
+
+    with _lock:
+        previous = _mirror.get(key)
+        recorded = {}
+        if previous:
+            # Cambios del propio bot posteriores a la consulta: la respuesta puede no incluirlos
+            for attendance_id, at in previous['recorded'].items():
+                if at >= started and attendance_id in previous['records']:
+                    records.setdefault(attendance_id, {}).update(previous['records'][attendance_id])
+                    recorded[attendance_id] = at
+        _mirror[key] = {'records': records, 'recorded': recorded, 'synced': time.monotonic()}
+        if recorded:
+            _trim(records)
+            return summarize(records.values())
+    return status
+
+def summarize(records, now=None):
+    """Resumen de estado a partir de las asistencias más recientes de un empleado
+
+    Devuelve un dict con la asistencia abierta ('open'), la última ('last'), la
+    última cerrada ('last_closed') y las horas de hoy ('today_hours', como en /report).
+    """
+    now = now or datetime.now(reports.CUBA_TZ)
+    ordered = sorted((dict(r) for r in records if r.get('check_in')),
+                     key=lambda r: (r['check_in'], r['id']), reverse=True)
+    daily, _, _ = reports.aggregate_hours(ordered, now)
+    return {
+        'open': next((r for r in ordered if not r.get('check_out')), None),
+        'last': ordered[0] if ordered else None,
+        'last_closed': next((r for r in ordered if r.get('check_out')), None),
+        'today_hours': daily.get(now.date(), 0.0)
+    }
+
+EMPTY_SUMMARY = {'open': None, 'last': None, 'last_closed': None, 'today_hours': 0.0}
+
+def get_status(odoo, employee_id, max_age=MAX_AGE):
+    """Resumen de estado (ver summarize) desde el espejo
+
+    Si el espejo es más antiguo que max_age se sincroniza antes con Odoo. Si la
+    sincronización falla se responde con el espejo anterior, si lo hay.
+    """
+    key = _key(odoo.url, odoo.db, employee_id)
+    with _lock:
+        entry = _mirror.get(key)
+        if entry and time.monotonic() - entry['synced'] <= max_age:
+            return summarize(entry['records'].values())
+
+    status = sync(odoo, employee_id)
+    if status is not None:
+        return status
+
+    logger.warning(f"No se pudo sincronizar el espejo de asistencias del empleado {employee_id}")
+    with _lock:
+        entry = _mirror.get(key)
+        return summarize(entry['records'].values()) if entry else dict(EMPTY_SUMMARY)
@@ -0,0 +1,229 @@
+"""Servidor Odoo falso (XML-RPC y JSON-RPC) para benchmarks sin red.
+
+Implementa common.authenticate y object.execute_kw para res.users, hr.employee
+y hr.attendance, con latencia y tasa de errores configurables.
+"""
+import json
+import time
+import random
+import itertools
+import threading
+import xmlrpc.client
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PASSWORD = 'secret'
+
+class FakeOdoo:
+    """Estado en memoria de una base de datos Odoo mínima"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.users = {}         # login -> uid
+        self.employees = {}     # uid -> employee
+        self.attendances = {}   # id -> registro
+        self.holidays = []      # resource.calendar.leaves globales
+        self.leaves = []        # hr.leave
+        self.requests = 0
+        self.errors = 0
+
+    def _simulate(self):
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise RuntimeError('Error inyectado por el servidor falso')
+
+    def authenticate(self, db, login, password, context):
+        self._simulate()
+        if password != PASSWORD:
+            return False
+        with self._lock:
+            uid = self.users.get(login)
+            if uid is None:
+                uid = next(self._ids)
+                self.users[login] = uid
+                employee_id = next(self._ids)
+                self.employees[uid] = {'id': employee_id, 'name': f'Empleado {login}',
+                                       'user_id': uid, 'partner_id': uid + 100000}
+            return uid
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        self._simulate()
+        kwargs = kwargs or {}
+        if password != PASSWORD:
+            raise PermissionError('AccessDenied')
+        handler = getattr(self, f"_{model.replace('.', '_')}_{method}", None)
+        if handler is None:
+            raise NotImplementedError(f'{model}.{method}')
+        with self._lock:
+            return handler(uid, args, kwargs)
+
+    def _res_users_read(self, uid, args, kwargs):
+        employee = self.employees[uid]
+        return [{'id': uid, 'partner_id': [employee['partner_id'], employee['name']]}]
+
+    def _hr_employee_search_read(self, uid, args, kwargs):
+        domain = args[0]
+        matches = []
+        for employee in self.employees.values():
+            if domain and domain[0] == '|':
+                # Solo se soporta un '|' inicial entre los dos primeros términos
+                matched = any(self._match_employee(employee, term) for term in domain[1:3])
+                matched = matched and all(self._match_employee(employee, term) for term in domain[3:])
+            else:
+                matched = all(self._match_employee(employee, term) for term in domain if isinstance(term, list))
+            if matched:
+                matches.append({'id': employee['id'], 'name': employee['name']})
+        return matches[:kwargs.get('limit') or None]
+
+    def _match_employee(self, employee, term):
+        field, _, value = term
+        if field == 'work_contact_id':
+            return employee['partner_id'] == value
+        if field == 'user_id':
+            return employee['user_id'] == value
+        if field == 'work_contact_id.user_ids':
+            return employee['user_id'] in (value if isinstance(value, list) else [value])
+        return True
+
+    def _now(self):
+        return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    def _hr_attendance_create(self, uid, args, kwargs):
+        values = args[0]
+        attendance_id = next(self._ids)
+        self.attendances[attendance_id] = {
+            'id': attendance_id, 'employee_id': values['employee_id'],
+            'check_in': values['check_in'], 'check_out': False, 'write_date': self._now()
+        }
+        return attendance_id
+
+    def _hr_attendance_write(self, uid, args, kwargs):
+        ids, values = args
+        for attendance_id in ids:
+            self.attendances[attendance_id].update(values, write_date=self._now())
+        return True
+
+    def _hr_attendance_unlink(self, uid, args, kwargs):
+        for attendance_id in args[0]:
+            self.attendances.pop(attendance_id, None)
+        return True
+
+    def _hr_attendance_search_read(self, uid, args, kwargs):
+        domain = args[0]
+        records = [r for r in self.attendances.values()
+                   if all(self._match_attendance(r, term) for term in domain if isinstance(term, list))]
+        order = kwargs.get('order') or 'id asc'
+        field, _, direction = order.split(',')[0].strip().partition(' ')
+        records.sort(key=lambda r: (r.get(field) or '', r['id']), reverse=direction.strip() == 'desc')
+        offset = kwargs.get('offset', 0)
+        limit = kwargs.get('limit')
+        records = records[offset:offset + limit if limit else None]
+        fields = kwargs.get('fields')
+        if fields:
+            records = [{f: r.get(f, False) for f in set(fields) | {'id'}} for r in records]
+        return [dict(r) for r in records]
+
+    def _resource_calendar_leaves_search_read(self, uid, args, kwargs):
+        return [dict(r) for r in self.holidays
+                if all(self._match_attendance(r, term) for term in args[0] if isinstance(term, list))]
+
+    def _hr_leave_search_read(self, uid, args, kwargs):
+        return [dict(r) for r in self.leaves
+                if all(self._match_attendance(r, term) for term in args[0] if isinstance(term, list))]
+
+    def _match_attendance(self, record, term):
+        field, operator, value = term
+        current = record.get(field)
+        if operator == '=':
+            return current == value
+        if operator == '!=':
+            return current != value
+        if current is False or current is None:
+            return False
+        if operator == '>':
+            return current > value
+        if operator == '>=':
+            return current >= value
+        if operator == '<':
+            return current < value
+        if operator == '<=':
+            return current <= value
+        if operator == 'in':
+            return current in value
+        return True
+
+def _make_handler(odoo):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, body, content_type, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/jsonrpc':
+                self._jsonrpc(json.loads(data))
+            elif self.path.startswith('/xmlrpc/2/'):
+                self._xmlrpc(data)
+            else:
+                self._reply(b'not found', 'text/plain', 404)
+
+        def _dispatch(self, method, args):
+            if method == 'authenticate':
+                return odoo.authenticate(*args)
+            if method == 'execute_kw':
+                return odoo.execute_kw(*args)
+            if method == 'version':
+                return {'server_version': '16.0'}
+            raise NotImplementedError(method)
+
+        def _xmlrpc(self, data):
+            args, method = xmlrpc.client.loads(data)
+            try:
+                body = xmlrpc.client.dumps((self._dispatch(method, args),), methodresponse=True, allow_none=True)
+            except PermissionError as e:
+                body = xmlrpc.client.dumps(xmlrpc.client.Fault(3, f'odoo.exceptions.AccessDenied: {e}'))
+            except Exception as e:
+                body = xmlrpc.client.dumps(xmlrpc.client.Fault(1, str(e)))
+            self._reply(body.encode('utf-8'), 'text/xml')
+
+        def _jsonrpc(self, payload):
+            params = payload['params']
+            try:
+                response = {'result': self._dispatch(params['method'], params['args'])}
+            except PermissionError as e:
+                response = {'error': {'code': 200, 'message': 'Odoo Server Error',
+                                      'data': {'name': 'odoo.exceptions.AccessDenied', 'message': str(e)}}}
+            except Exception as e:
+                response = {'error': {'code': 200, 'message': 'Odoo Server Error',
+                                      'data': {'name': type(e).__name__, 'message': str(e)}}}
+            response.update(jsonrpc='2.0', id=payload.get('id'))
+            self._reply(json.dumps(response).encode('utf-8'), 'application/json')
+
+    return Handler
+
+def start(latency=0.0, error_rate=0.0, seed=None):
+    """Arrancar el servidor en un hilo. Devuelve (url, estado, servidor)"""
+    odoo = FakeOdoo(latency=latency, error_rate=error_rate, seed=seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(odoo))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-odoo', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}', odoo, server
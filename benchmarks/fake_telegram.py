@@ -0,0 +1,121 @@
+"""Servidor falso de la API de Telegram (getUpdates, sendMessage y editMessageText)."""
+import json
+import time
+import itertools
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeTelegram:
+    """Cola de updates inyectados y registro de los mensajes enviados por el bot"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._condition = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.updates = []
+        self.sent = []
+
+    def inject(self, user_id, text):
+        """Añadir un mensaje de usuario; devuelve el update_id"""
+        with self._condition:
+            update_id = next(self._update_ids)
+            self.updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+                    'text': text
+                }
+            })
+            self._condition.notify_all()
+            return update_id
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + min(timeout, 1.0)
+        with self._condition:
+            while True:
+                pending = [u for u in self.updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    # Telegram olvida los updates confirmados por el offset
+                    self.updates = pending
+                    return pending[:100]
+                self._condition.wait(remaining)
+
+    def record(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._condition:
+            message_id = next(self._message_ids) if method == 'sendMessage' else int(params.get('message_id', 0))
+            self.sent.append({'method': method, 'chat_id': int(params.get('chat_id', 0)),
+                              'text': params.get('text', ''), 'time': time.monotonic(),
+                              'message_id': message_id})
+            self._condition.notify_all()
+            return message_id
+
+    def wait_for(self, count, timeout):
+        """Esperar a que el bot haya enviado `count` mensajes"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+def _make_handler(telegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self):
+            query = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+            length = int(self.headers.get('Content-Length', 0))
+            if length:
+                body = self.rfile.read(length).decode('utf-8', errors='replace')
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    query.update(json.loads(body))
+                else:
+                    query.update({k: v[-1] for k, v in parse_qs(body).items()})
+            return query
+
+        def _handle(self):
+            method = urlparse(self.path).path.rsplit('/', 1)[-1]
+            params = self._params()
+            if method == 'getUpdates':
+                updates = telegram.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+                self._reply({'ok': True, 'result': updates})
+            elif method in ('sendMessage', 'editMessageText', 'answerCallbackQuery', 'sendDocument'):
+                message_id = telegram.record(method, params)
+                self._reply({'ok': True, 'result': {'message_id': message_id, 'chat': {'id': params.get('chat_id')}}})
+            else:
+                self._reply({'ok': True, 'result': True})
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+def start(latency=0.0):
+    """Arrancar el servidor en un hilo. Devuelve (url_base_api, estado, servidor)"""
+    telegram = FakeTelegram(latency=latency)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-telegram', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/botTEST', telegram, server
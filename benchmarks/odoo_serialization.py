@@ -0,0 +1,90 @@
+"""Comparar el coste de serialización XML-RPC frente a JSON-RPC para lecturas de hr.attendance.
+
+Uso: python benchmarks/odoo_serialization.py [--records 1 10 100 1000] [--repeat 200]
+"""
+import sys
+import json
+import time
+import argparse
+import xmlrpc.client
+from datetime import datetime, timedelta
+
+FIELDS = ['id', 'employee_id', 'check_in', 'check_out', 'worked_hours']
+
+def build_attendances(count):
+    """Registros con la forma que devuelve search_read de hr.attendance"""
+    start = datetime(2024, 1, 1, 8, 0, 0)
+    records = []
+    for i in range(count):
+        check_in = start + timedelta(days=i)
+        records.append({
+            'id': 1000 + i,
+            'employee_id': [42, 'Empleado de prueba'],
+            'check_in': check_in.strftime('%Y-%m-%d %H:%M:%S'),
+            'check_out': (check_in + timedelta(hours=8, minutes=30)).strftime('%Y-%m-%d %H:%M:%S'),
+            'worked_hours': 8.5
+        })
+    return records
+
+def request_args(count):
+    return ('db', 2, 'password', 'hr.attendance', 'search_read',
+            [[['employee_id', '=', 42]]], {'fields': FIELDS, 'limit': count, 'order': 'id desc'})
+
+def xmlrpc_roundtrip(args, records):
+    request = xmlrpc.client.dumps(args, 'execute_kw').encode('utf-8')
+    response = xmlrpc.client.dumps((records,), methodresponse=True).encode('utf-8')
+    xmlrpc.client.loads(request)
+    xmlrpc.client.loads(response)
+    return len(request), len(response)
+
+def jsonrpc_roundtrip(args, records):
+    request = json.dumps({
+        'jsonrpc': '2.0', 'method': 'call', 'id': 1,
+        'params': {'service': 'object', 'method': 'execute_kw', 'args': list(args)}
+    }, separators=(',', ':')).encode('utf-8')
+    response = json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': records},
+                          separators=(',', ':')).encode('utf-8')
+    json.loads(request)
+    json.loads(response)
+    return len(request), len(response)
+
+def measure(roundtrip, args, records, repeat):
+    sizes = roundtrip(args, records)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        roundtrip(args, records)
+    elapsed = (time.perf_counter() - start) / repeat
+    return {'request_bytes': sizes[0], 'response_bytes': sizes[1], 'usec_per_call': elapsed * 1e6}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='Imprimir el resultado como JSON')
+    options = parser.parse_args(argv)
+
+    results = []
+    for count in options.records:
+        args = request_args(count)
+        records = build_attendances(count)
+        results.append({
+            'records': count,
+            'xmlrpc': measure(xmlrpc_roundtrip, args, records, options.repeat),
+            'jsonrpc': measure(jsonrpc_roundtrip, args, records, options.repeat)
+        })
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return results
+
+    print(f"{'registros':>10} {'protocolo':>9} {'req (B)':>9} {'resp (B)':>10} {'us/llamada':>11}")
+    for result in results:
+        for protocol in ('xmlrpc', 'jsonrpc'):
+            row = result[protocol]
+            print(f"{result['records']:>10} {protocol:>9} {row['request_bytes']:>9} "
+                  f"{row['response_bytes']:>10} {row['usec_per_call']:>11.1f}")
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Benchmarks sin red del scheduler y del bucle de comandos contra servidores falsos.
+
+Ejemplos:
+    python benchmarks/run.py --scenario scheduler --users 10 100 5000
+    python benchmarks/run.py --scenario commands --users 100 --odoo-latency 0.05 --output results.json
+
+El resultado es una lista JSON con throughput, latencias p50/p95/p99 y pico de memoria
+por escenario, para poder comparar entre cambios.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Aislar la persistencia del bot antes de importar sus módulos
+os.environ.setdefault('PERSISTENCE_DB', os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.sqlite3'))
+
+import fake_odoo  # noqa: E402
+import fake_telegram  # noqa: E402
+
+def percentiles(samples):
+    if not samples:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99)}
+
+def _reset_bot_state(odoo_url, users, protocol):
+    import handlers
+    import odoo_api
+    import attendance_cache
+    import storage
+    # Cada escenario arranca servidores falsos nuevos (update_id desde 1): no arrastrar el
+    # offset de Telegram, los updates pendientes ni las marcas del escenario anterior. La
+    # versión de las configuraciones se conserva para que el scheduler relea las nuevas
+    store = storage.get_store()
+    store.transaction([('DELETE FROM meta WHERE key != ?', (storage.CONFIGS_VERSION_KEY,)),
+                       ('DELETE FROM pending_updates', ()), ('DELETE FROM scheduled_marks', ()),
+                       ('DELETE FROM user_configs', ()), ('DELETE FROM user_states', ())])
+    odoo_api.DEFAULT_PROTOCOL = protocol
+    odoo_api._session_cache.clear()
+    attendance_cache._mirror.clear()
+    handlers.user_configs.clear()
+    handlers.user_states.clear()
+    for user_id in range(1, users + 1):
+        handlers.user_configs[user_id] = {
+            'url': odoo_url, 'db': 'bench',
+            'username': f'user{user_id}', 'password': fake_odoo.PASSWORD
+        }
+    # El scheduler lee las configuraciones del almacén compartido
+    store.write_users(handlers.user_configs, handlers.user_states, set(handlers.user_configs))
+
+def bench_scheduler(users, odoo_latency, error_rate, protocol, seed, profile=None):
+    """Ejecutar scheduled_check_in para `users` usuarios y medir latencia por usuario
+
+    Con `profile` (prefijo de archivo) se ejecuta con cProfile y se guarda el .pstats.
+    """
+    import scheduler
+    import profiler
+    odoo_url, odoo, server = fake_odoo.start(latency=odoo_latency, error_rate=error_rate, seed=seed)
+    _reset_bot_state(odoo_url, users, protocol)
+
+    samples = []
+    samples_lock = threading.Lock()
+    original = scheduler._mark_user
+
+    def timed_mark_user(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            with samples_lock:
+                samples.append(time.perf_counter() - start)
+
+    scheduler._mark_user = timed_mark_user
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        if profile:
+            summary, stats = profiler.profile_call(scheduler.scheduled_check_in)
+            stats.dump_stats(f"{profile}-scheduler-{users}.pstats")
+        else:
+            summary = scheduler.scheduled_check_in()
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        scheduler._mark_user = original
+        server.shutdown()
+
+    return {
+        'scenario': 'scheduler',
+        'users': users,
+        'protocol': protocol,
+        'odoo_latency': odoo_latency,
+        'error_rate': error_rate,
+        'elapsed': elapsed,
+        'throughput': users / elapsed if elapsed else 0.0,
+        'successes': summary['successes'],
+        'failures': summary['failures'],
+        'odoo_requests': odoo.requests,
+        'latency': percentiles(samples),
+        'peak_memory_bytes': peak
+    }
+
+def bench_commands(users, commands_per_user, odoo_latency, error_rate, protocol, seed, command='/status'):
+    """Inyectar comandos en el Telegram falso y medir el bucle de updates completo"""
+    from telegram_bot import TelegramBot
+    from dispatcher import UpdateLoop
+    odoo_url, odoo, odoo_server = fake_odoo.start(latency=odoo_latency, error_rate=error_rate, seed=seed)
+    telegram_url, telegram, telegram_server = fake_telegram.start()
+    _reset_bot_state(odoo_url, users, protocol)
+
+    bot = TelegramBot('TEST')
+    bot.api_url = telegram_url
+    loop = UpdateLoop(bot)
+    threading.Thread(target=loop.run, name='bench-loop', daemon=True).start()
+
+    total = users * commands_per_user
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(commands_per_user):
+        for user_id in range(1, users + 1):
+            telegram.inject(user_id, command)
+
+    deadline = time.monotonic() + max(60, total)
+    while loop.latencies.count < total and time.monotonic() < deadline:
+        time.sleep(0.01)
+    handled = time.perf_counter() - start
+    while bot.outbox.depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    odoo_server.shutdown()
+    telegram_server.shutdown()
+
+    return {
+        'scenario': 'commands',
+        'command': command,
+        'users': users,
+        'commands': total,
+        'handled': loop.latencies.count,
+        'protocol': protocol,
+        'odoo_latency': odoo_latency,
+        'error_rate': error_rate,
+        'elapsed_handled': handled,
+        'elapsed': elapsed,
+        'throughput': loop.latencies.count / handled if handled else 0.0,
+        'telegram_calls': len(telegram.sent),
+        'odoo_requests': odoo.requests,
+        'latency': percentiles(list(loop.latencies._samples)),
+        'peak_memory_bytes': peak
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', nargs='+', choices=('scheduler', 'commands'), default=['scheduler', 'commands'])
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--commands-per-user', type=int, default=1)
+    parser.add_argument('--command', default='/status')
+    parser.add_argument('--odoo-latency', type=float, default=0.0, help='Segundos añadidos a cada RPC')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fracción de RPC que fallan')
+    parser.add_argument('--protocol', choices=('xmlrpc', 'jsonrpc'), default='xmlrpc')
+    parser.add_argument('--window', type=float, help='Ventana de reparto del scheduler en segundos (SCHEDULER_WINDOW)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Archivo donde guardar el JSON (por defecto stdout)')
+    parser.add_argument('--profile', help='Prefijo de los .pstats de cProfile del escenario scheduler')
+    options = parser.parse_args(argv)
+
+    if options.window is not None:
+        import scheduler
+        scheduler.WINDOW = options.window
+
+    results = []
+    for scenario in options.scenario:
+        for users in options.users:
+            if scenario == 'scheduler':
+                result = bench_scheduler(users, options.odoo_latency, options.error_rate,
+                                         options.protocol, options.seed, profile=options.profile)
+            else:
+                result = bench_commands(users, options.commands_per_user, options.odoo_latency,
+                                        options.error_rate, options.protocol, options.seed,
+                                        command=options.command)
+            results.append(result)
+            print(f"{scenario} users={users}: {result['throughput']:.1f}/s "
+                  f"p99={result['latency']['p99'] * 1000:.1f}ms", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return results
+
+if __name__ == '__main__':
+    main()
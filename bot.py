@@ -1,20 +1,24 @@
+import time
+
+# Inicio del proceso, para medir el tiempo de arranque
+_STARTED = time.perf_counter()
+
 import os
+import atexit
+import signal
+import hashlib
 import logging
 import threading
 import pytz
-import time
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.triggers.cron import CronTrigger
+import storage
+import coordination
 from telegram_bot import TelegramBot
-from handlers import (
-    handle_start, handle_config, handle_status, handle_test,
-    handle_manual_in, handle_manual_out, handle_check_status, handle_exit, handle_message,
-    handle_users, handle_rm, load_persistent_data
-)
-from scheduler import scheduled_check_in, scheduled_check_out
-from web_server import run_web_server
+from handlers import load_persistent_data
+from dispatcher import UpdateLoop
 from keep_alive import KeepAlive
 
+# Flask, APScheduler y el scheduler se importan en sus hilos para no retrasar el primer comando
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -23,152 +27,147 @@ logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 CUBA_TZ = pytz.timezone('America/Havana')
+# URL pública para el webhook de Telegram (Render define RENDER_EXTERNAL_URL). Sin URL se usa polling
+WEBHOOK_URL = (os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL') or '').rstrip('/')
+WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+
+def webhook_secret():
+    """Secreto de la ruta y de la cabecera del webhook (derivado del token si no se configura)"""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{BOT_TOKEN}".encode('utf-8')).hexdigest()[:32]
+
+class StartupTimer:
+    """Duración de cada fase del arranque, para el log"""
+
+    def __init__(self, started=_STARTED):
+        self.started = started
+        self._last = started
+        self._lock = threading.Lock()
+        self.phases = []
+
+    def mark(self, phase):
+        """Cerrar una fase del hilo principal"""
+        now = time.perf_counter()
+        self.record(phase, now - self._last)
+        self._last = now
+
+    def record(self, phase, seconds):
+        """Registrar una fase que se ejecutó en otro hilo"""
+        with self._lock:
+            self.phases.append((phase, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self, title):
+        with self._lock:
+            phases = ', '.join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in self.phases)
+        logger.info(f"{title} en {self.elapsed() * 1000:.0f}ms ({phases})")
+
+def start_webhook(bot, updates):
+    """Registrar el webhook en Telegram. Devuelve False si hay que usar polling"""
+    if not WEBHOOK_URL:
+        return False
+    from web_server import set_update_handler
+    secret = webhook_secret()
+    set_update_handler(secret, updates.submit_threadsafe)
+    if bot.set_webhook(f"{WEBHOOK_URL}/telegram/{secret}", secret):
+        logger.info(f"Webhook registrado en {WEBHOOK_URL}/telegram/...")
+        return True
+    logger.warning("No se pudo registrar el webhook, se usará polling")
+    set_update_handler(None, None)
+    return False
+
+def run_web_server_thread(timer):
+    start = time.perf_counter()
+    from web_server import run_web_server
+    timer.record('flask', time.perf_counter() - start)
+    run_web_server()
+
+def run_scheduler_thread(timer):
+    """Importar y arrancar el scheduler, los reintentos y la recuperación de marcas perdidas"""
+    start = time.perf_counter()
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    import mark_queue
+    import coordination
+    from scheduler import MISFIRE_GRACE, run_tick, run_retry_worker
+    
+    scheduler = BlockingScheduler(timezone=CUBA_TZ)
+    
+    # Un solo tick por minuto; el horario de cada usuario está en el índice de schedules
+    scheduler.add_job(
+        run_tick,
+        CronTrigger(second=0, timezone=CUBA_TZ),
+        id='tick',
+        max_instances=4,
+        misfire_grace_time=MISFIRE_GRACE,
+        coalesce=True
+    )
+    
+    # Solo el líder procesa el tick (con SCHEDULER_SHARDING cada instancia ejecuta su parte desde la cola)
+    coordinator = coordination.get_coordinator()
+    
+    def take_over():
+        # Las marcas de una ejecución interrumpida (reinicio o caída del líder anterior) se
+        # reintentan; las que el líder anterior aún está ejecutando siguen reservadas
+        mark_queue.release_orphans()
+        # Recuperar los minutos perdidos mientras no había líder (relee usuarios y horarios del almacén)
+        threading.Thread(target=run_tick, name='catch-up', daemon=True).start()
+    
+    coordinator.on_leader(take_over)
+    coordinator.start()
+    
+    # Reintentos de marcas fallidas y, con sharding, la parte de esta instancia de cada marcado
+    threading.Thread(target=run_retry_worker, name='mark-retries', daemon=True).start()
+    timer.record('scheduler', time.perf_counter() - start)
+    logger.info("Scheduler iniciado en hilo separado")
+    
+    scheduler.start()
+
+def shutdown():
+    """Guardar los cambios pendientes y soltar el lease para que otra instancia tome el relevo ya"""
+    storage.flush_all()
+    coordination.release()
 
-ALLOWED_USERS = []  # Lista vacía para permitir a todos los usuarios
-
-def clear_pending_updates(bot):
-    """Limpia todos los mensajes pendientes en la cola de Telegram"""
-    try:
-        logger.info("Limpiando mensajes pendientes...")
-        updates = bot.get_updates()
-        
-        if updates and updates.get('ok'):
-            result = updates.get('result', [])
-            if result:
-                last_update_id = result[-1]['update_id']
-                # Confirmar que se procesaron todos los mensajes
-                bot.offset = last_update_id + 1
-                updates = bot.get_updates()
-                logger.info(f"Limpiados {len(result)} mensajes pendientes. Nuevo offset: {bot.offset}")
-            else:
-                logger.info("No hay mensajes pendientes")
-        else:
-            logger.info("No se pudieron obtener updates para limpiar")
-    except Exception as e:
-        logger.error(f"Error limpiando mensajes pendientes: {e}")
-
-def is_user_allowed(user_id):
-    """Verifica si el usuario está permitido"""
-    if not ALLOWED_USERS:
-        return True  # Permitir a todos los usuarios si ALLOWED_USERS está vacío
-    return user_id in ALLOWED_USERS
+def handle_sigterm(signum, frame):
+    # Render detiene las instancias con SIGTERM, y con la acción por defecto no se ejecutan los atexit
+    logger.info("SIGTERM recibido: guardando datos pendientes y soltando el lease")
+    shutdown()
+    raise SystemExit(0)
 
 def main():
     """Función principal"""
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    atexit.register(coordination.release)
+    timer = StartupTimer()
+    timer.mark('imports')
     bot = TelegramBot(BOT_TOKEN)
     
     # Cargar datos persistentes al inicio
     load_persistent_data()
-    logger.info("Datos persistentes cargados al inicio")
-    
-    clear_pending_updates(bot)
-    time.sleep(2)  # Esperar un poco antes de continuar
-    clear_pending_updates(bot)  # Segunda limpieza para asegurar
-    
-    from handlers import user_configs, user_states
+    from handlers import user_configs
     logger.info(f"Usuarios configurados al inicio: {len(user_configs)}")
+    timer.mark('datos')
+    
+    updates = UpdateLoop(bot, on_first_handled=lambda: timer.report("Primer comando atendido"))
     
-    web_server_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_server_thread.start()
-    logger.info("Servidor web iniciado en hilo separado")
+    # Servidor web y scheduler en paralelo con el primer getUpdates
+    threading.Thread(target=run_web_server_thread, args=(timer,), name='web-server', daemon=True).start()
+    threading.Thread(target=run_scheduler_thread, args=(timer,), name='scheduler', daemon=True).start()
     
     keep_alive = KeepAlive()
     keep_alive.start_keep_alive()
     
-    # Configurar scheduler
-    scheduler = BlockingScheduler(timezone=CUBA_TZ)
-    
-    scheduler.add_job(
-        scheduled_check_in,
-        CronTrigger(hour=11, minute=58, day_of_week='mon-fri', timezone=CUBA_TZ),
-        id='check_in'
-    )
-    
-    scheduler.add_job(
-        scheduled_check_out,
-        CronTrigger(hour=21, minute=30, day_of_week='mon-thu', timezone=CUBA_TZ),
-        id='check_out_weekdays'
-    )
-    
-    scheduler.add_job(
-        scheduled_check_out,
-        CronTrigger(hour=20, minute=30, day_of_week='fri', timezone=CUBA_TZ),
-        id='check_out_friday'
-    )
-    
-    def run_scheduler():
-        scheduler.start()
-    
-    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-    scheduler_thread.start()
-    logger.info("Scheduler iniciado en hilo separado")
+    # Webhook si hay URL pública; si no, long polling desde el offset guardado
+    webhook = start_webhook(bot, updates)
+    timer.mark('telegram')
     
-    logger.info("Bot iniciado")
+    timer.report("Bot iniciado")
     
-    while True:
-        try:
-            updates = bot.get_updates()
-            
-            if updates and updates.get('ok'):
-                result = updates.get('result', [])
-                
-                last_update_id = None
-                
-                for update in result:
-                    update_id = update['update_id']
-                    last_update_id = update_id
-                    
-                    if 'message' in update:
-                        message = update['message']
-                        chat_id = message['chat']['id']
-                        user_id = message['from']['id']
-                        
-                        if not is_user_allowed(user_id):
-                            bot.send_message(chat_id, "❌ Lo siento, este bot está limitado a usuarios autorizados.")
-                            continue
-                        
-                        if 'text' in message:
-                            text = message['text']
-                            
-                            try:
-                                if text == '/start':
-                                    handle_start(bot, chat_id, user_id)
-                                elif text == '/config':
-                                    handle_config(bot, chat_id, user_id)
-                                elif text == '/status':
-                                    handle_status(bot, chat_id, user_id)
-                                elif text == '/test':
-                                    handle_test(bot, chat_id, user_id)
-                                elif text == '/manual_in':
-                                    handle_manual_in(bot, chat_id, user_id)
-                                elif text == '/manual_out':
-                                    handle_manual_out(bot, chat_id, user_id)
-                                elif text == '/check_status':
-                                    handle_check_status(bot, chat_id, user_id)
-                                elif text == '/exit':
-                                    handle_exit(bot, chat_id, user_id)
-                                elif text == '/users':
-                                    handle_users(bot, chat_id, user_id)
-                                elif text.startswith('/rm'):
-                                    parts = text.split()
-                                    if len(parts) == 2:
-                                        username = parts[1]
-                                        handle_rm(bot, chat_id, user_id, username)
-                                    else:
-                                        bot.send_message(chat_id, "Uso: /rm <username>")
-                                elif not text.startswith('/'):
-                                    handle_message(bot, chat_id, user_id, text)
-                            except Exception as e:
-                                logger.error(f"Error procesando mensaje: {e}")
-                
-                if last_update_id is not None:
-                    bot.offset = last_update_id + 1
-            
-            time.sleep(1)
-            
-        except Exception as e:
-            logger.error(f"Error en loop principal: {e}")
-            time.sleep(5)
+    # Bucle asyncio: comandos de usuarios distintos en paralelo, cada usuario en orden
+    updates.run(webhook=webhook)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
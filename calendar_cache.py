@@ -0,0 +1,135 @@
+import os
+import time
+import logging
+import threading
+import xmlrpc.client
+from datetime import datetime, timedelta
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# No marcar a los empleados con festivo o ausencia aprobada ese día
+ENABLED = os.environ.get('SCHEDULER_SKIP_TIME_OFF', 'true').lower() in ('1', 'true', 'yes')
+# Segundos antes de volver a consultar una base de datos cuya consulta falló
+FAILURE_RETRY = float(os.environ.get('TIME_OFF_FAILURE_RETRY', 60))
+
+CUBA_TZ = pytz.timezone('America/Havana')
+
+# Por (url, db): día consultado, festivos y ausencias del día y si la consulta falló
+_cache = {}
+_lock = threading.Lock()
+# Un lock por base de datos para que solo un hilo haga la consulta y el resto espere su resultado
+_fetch_locks = {}
+
+ODOO_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class TimeOffUnavailable(Exception):
+    """No se pudieron consultar los festivos y ausencias por un error de red o del servidor"""
+
+def _is_permanent(error):
+    """Odoo no tiene el modelo (sin el módulo de ausencias) o el usuario no puede leerlo"""
+    if not isinstance(error, xmlrpc.client.Fault):
+        return False
+    message = str(error.faultString)
+    return "doesn't exist" in message or 'AccessError' in message
+
+def _key(url, db):
+    return (url.rstrip('/'), db)
+
+def _to_odoo(moment):
+    """Fecha y hora con zona horaria como cadena UTC de Odoo"""
+    return moment.astimezone(pytz.utc).strftime(ODOO_FORMAT)
+
+def _day_bounds(day):
+    """Inicio y fin del día local de Cuba, como cadenas UTC de Odoo"""
+    start = CUBA_TZ.localize(datetime.combine(day, datetime.min.time()))
+    end = CUBA_TZ.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return _to_odoo(start), _to_odoo(end)
+
+def _fresh(entry, day):
+    if entry is None or entry['day'] != day:
+        return False
+    return entry['failed_at'] is None or time.monotonic() - entry['failed_at'] < FAILURE_RETRY
+
+def _fetch(odoo, day):
+    """Consultar los festivos y ausencias del día: dos llamadas por base de datos (tres si
+    hay festivos de un calendario concreto)
+
+    Los intervalos se guardan como cadenas UTC de Odoo, que se comparan bien como texto.
+    """
+    start, end = _day_bounds(day)
+    time_off = odoo.get_time_off(start, end)
+    # Festivos de todos los calendarios y, por empleado, días completos e intervalos
+    holidays = []
+    full_day = set()
+    intervals = {}
+    by_calendar = {}
+    calendars = {calendar_id for calendar_id, _, _ in time_off['holidays'] if calendar_id is not None}
+    if calendars:
+        by_calendar = odoo.get_calendar_employees(calendars)
+    for calendar_id, date_from, date_to in time_off['holidays']:
+        if calendar_id is None:
+            holidays.append((date_from, date_to))
+            continue
+        for employee_id in by_calendar.get(calendar_id, ()):
+            intervals.setdefault(employee_id, []).append((date_from, date_to))
+    for employee_id, date_from, date_to, whole_day in time_off['leaves']:
+        if whole_day:
+            full_day.add(employee_id)
+        else:
+            intervals.setdefault(employee_id, []).append((date_from, date_to))
+    return {'day': day, 'holidays': holidays, 'full_day': full_day, 'intervals': intervals,
+            'failed_at': None}
+
+def get_day(odoo, day):
+    """Festivos y ausencias de la base de datos de `odoo` para `day` (se consultan una vez al día)"""
+    key = _key(odoo.url, odoo.db)
+    with _lock:
+        entry = _cache.get(key)
+        if _fresh(entry, day):
+            return entry
+        fetch_lock = _fetch_locks.setdefault(key, threading.Lock())
+
+    with fetch_lock:
+        with _lock:
+            entry = _cache.get(key)
+            if _fresh(entry, day):
+                return entry
+        try:
+            entry = _fetch(odoo, day)
+            summary = (f"{len(entry['holidays'])} festivos generales, "
+                       f"{len(entry['full_day'])} empleados libres todo el día, "
+                       f"{len(entry['intervals'])} con ausencias parciales")
+            logger.info(f"Festivos y ausencias de {odoo.db} para {day}: {summary}")
+        except Exception as e:
+            entry = {'day': day, 'holidays': [], 'full_day': set(), 'intervals': {},
+                     'failed_at': time.monotonic()}
+            if _is_permanent(e):
+                # No cambiará al reintentar: se marca a todos como antes de existir esta comprobación
+                logger.warning(f"Odoo rechazó la consulta de festivos y ausencias de {odoo.db}; se marca a todos: {e}")
+            else:
+                # Error de red o del servidor: las marcas van a la cola de reintentos en lugar de
+                # marcar a quien podría estar de vacaciones
+                logger.warning(f"No se pudieron consultar festivos y ausencias de {odoo.db}: {e}")
+                entry['error'] = repr(e)
+        with _lock:
+            _cache[key] = entry
+        return entry
+
+def is_off(odoo, employee_id, at):
+    """Si el empleado no trabaja en el instante `at` (datetime con zona horaria)
+
+    Cuenta una ausencia aprobada de día completo ese día, o un festivo o ausencia parcial
+    (medio día, por horas) que cubra `at`. Lanza TimeOffUnavailable si la consulta falló por
+    la red o el servidor; si Odoo la rechazó se considera que trabaja.
+    """
+    if not ENABLED:
+        return False
+    entry = get_day(odoo, at.astimezone(CUBA_TZ).date())
+    if entry.get('error'):
+        raise TimeOffUnavailable(entry['error'])
+    if employee_id in entry['full_day']:
+        return True
+    moment = _to_odoo(at)
+    return any(date_from <= moment < date_to
+               for date_from, date_to in entry['holidays'] + entry['intervals'].get(employee_id, []))
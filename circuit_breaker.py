@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Fallos de red seguidos que abren el circuito de un host de Odoo
+FAILURE_THRESHOLD = int(os.environ.get('ODOO_BREAKER_FAILURES', 5))
+# Segundos con el circuito abierto antes de probar el host de nuevo en segundo plano
+RESET_TIMEOUT = float(os.environ.get('ODOO_BREAKER_RESET', 30))
+# Espera máxima entre pruebas si el host sigue caído
+MAX_RESET_TIMEOUT = float(os.environ.get('ODOO_BREAKER_MAX_RESET', 300))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# Valor del estado en la métrica odoo_circuit_state
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """El host está marcado como caído: la llamada falla sin esperar al timeout"""
+
+class CircuitBreaker:
+    """Circuito por host: cerrado, abierto (falla rápido) y medio abierto (probando el host)
+
+    Mientras está abierto ninguna llamada de usuario llega al host; una prueba en segundo
+    plano decide cuándo vuelve a cerrarse.
+    """
+
+    def __init__(self, host, probe=None, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT, max_reset_timeout=MAX_RESET_TIMEOUT):
+        self.host = host
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._next_reset = reset_timeout
+        self._lock = threading.Lock()
+        self._set_state(CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.ODOO_CIRCUIT_STATE.set(STATE_VALUES[state], host=self.host)
+
+    def before_call(self):
+        """Lanzar CircuitOpenError si el host no está disponible"""
+        with self._lock:
+            if self.state != CLOSED:
+                raise CircuitOpenError(f"Servidor Odoo {self.host} no disponible (circuito {self.state})")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self, error=None):
+        with self._lock:
+            if self.state != CLOSED:
+                return
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return
+            self._open()
+        logger.error(f"Circuito abierto para {self.host} tras {self.failure_threshold} fallos seguidos: {error}")
+
+    def _open(self):
+        """Abrir el circuito y programar la siguiente prueba (con el lock tomado)"""
+        self._set_state(OPEN)
+        self.opened_at = time.time()
+        timer = threading.Timer(self._next_reset, self._run_probe)
+        timer.daemon = True
+        timer.start()
+
+    def _run_probe(self):
+        with self._lock:
+            self._set_state(HALF_OPEN)
+        try:
+            ok = self.probe is None or self.probe()
+        except Exception as e:
+            logger.warning(f"Prueba de {self.host} fallida: {e}")
+            ok = False
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                self._next_reset = self.reset_timeout
+                self._set_state(CLOSED)
+            else:
+                self._next_reset = min(self._next_reset * 2, self.max_reset_timeout)
+                self._open()
+        if ok:
+            logger.info(f"Circuito cerrado para {self.host}: el servidor responde de nuevo")
+
+    def snapshot(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'opened_at': self.opened_at}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(host, probe=None):
+    """Circuito compartido de un host; `probe` se usa al crearlo"""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, probe)
+            _breakers[host] = breaker
+        return breaker
+
+def states():
+    """Estado de los circuitos de todos los hosts conocidos"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.host: breaker.snapshot() for breaker in breakers}
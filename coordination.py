@@ -0,0 +1,159 @@
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+import storage
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Coordinación entre instancias a través del almacén compartido (PERSISTENCE_DB)
+INSTANCE_ID = os.environ.get('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# Segundos que dura el lease del líder sin renovarse; marca el tiempo máximo de failover
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 15))
+# Repartir los usuarios de cada marcado entre todas las instancias vivas en lugar de usar solo el líder
+SHARDING = os.environ.get('SCHEDULER_SHARDING', '').lower() in ('1', 'true', 'yes')
+
+LEADER_LEASE = 'scheduler'
+
+class Coordinator:
+    """Elección de líder con un lease en SQLite y latidos de las instancias vivas
+
+    El líder ejecuta las tareas programadas; si deja de renovar el lease, otra
+    instancia lo toma en cuanto caduca. Con SHARDING cada instancia viva procesa
+    su parte de los usuarios.
+    """
+
+    def __init__(self, store=None, instance_id=INSTANCE_ID, ttl=LEASE_TTL, sharding=SHARDING):
+        self.store = store or storage.get_store()
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.sharding = sharding
+        self._lock = threading.Lock()
+        self._leader_until = 0.0
+        self._leader = False
+        self._members = [instance_id]
+        self._on_leader = []
+        self._thread = None
+        # Tras release() no se vuelve a tomar el lease aunque el proceso tarde en terminar
+        self._stopped = False
+
+    def on_leader(self, callback):
+        """Registrar una función que se llama cada vez que esta instancia pasa a ser líder"""
+        self._on_leader.append(callback)
+
+    def is_leader(self):
+        # Con margen: se deja de actuar como líder antes de que el lease caduque para los demás
+        with self._lock:
+            return time.monotonic() < self._leader_until
+
+    def members(self):
+        with self._lock:
+            return list(self._members)
+
+    def owns(self, user_id):
+        """Si esta instancia debe procesar al usuario en el marcado repartido"""
+        members = self.members()
+        if self.instance_id not in members:
+            return False
+        digest = hashlib.sha1(str(user_id).encode('utf-8')).digest()
+        return members[int.from_bytes(digest[:8], 'big') % len(members)] == self.instance_id
+
+    def _acquire(self):
+        """Tomar o renovar el lease. Devuelve True si esta instancia es el líder"""
+        now = time.time()
+        started = time.monotonic()
+        self.store.execute(
+            'INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+            'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+            (LEADER_LEASE, self.instance_id, now + self.ttl, now)
+        )
+        rows = self.store.execute('SELECT owner FROM leases WHERE name = ?', (LEADER_LEASE,))
+        leader = bool(rows) and rows[0][0] == self.instance_id
+        with self._lock:
+            self._leader_until = started + self.ttl * 2 / 3 if leader else 0.0
+        return leader
+
+    def _heartbeat(self):
+        now = time.time()
+        self.store.execute('INSERT OR REPLACE INTO members (instance, heartbeat) VALUES (?, ?)',
+                           (self.instance_id, now))
+        self.store.execute('DELETE FROM members WHERE heartbeat < ?', (now - self.ttl * 4,))
+        rows = self.store.execute('SELECT instance FROM members WHERE heartbeat >= ? ORDER BY instance',
+                                  (now - self.ttl,))
+        members = [instance for instance, in rows]
+        with self._lock:
+            changed = members != self._members
+            self._members = members
+        if changed:
+            logger.info(f"Instancias activas: {len(members)} ({', '.join(members)})")
+
+    def step(self):
+        """Un ciclo de coordinación: latido y renovación del lease"""
+        if self._stopped:
+            return
+        was_leader = self._leader
+        try:
+            if self.sharding:
+                self._heartbeat()
+            leader = self._acquire()
+        except Exception as e:
+            logger.error(f"Error renovando el lease: {e}")
+            return
+        self._leader = leader
+        if leader and not was_leader:
+            logger.info(f"Instancia {self.instance_id} es ahora el líder del scheduler")
+            for callback in self._on_leader:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Error al asumir el liderazgo: {e}")
+        elif was_leader and not leader:
+            logger.warning(f"Instancia {self.instance_id} perdió el liderazgo del scheduler")
+
+    def start(self):
+        """Primer ciclo en el hilo actual y renovación periódica en segundo plano"""
+        if self._thread is not None:
+            return
+        self.step()
+        self._thread = threading.Thread(target=self._run, name='coordination', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            self.step()
+
+    def release(self):
+        """Soltar el lease al salir para que otra instancia tome el relevo sin esperar"""
+        with self._lock:
+            self._leader_until = 0.0
+        self._leader = False
+        self._stopped = True
+        try:
+            self.store.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (LEADER_LEASE, self.instance_id))
+            self.store.execute('DELETE FROM members WHERE instance = ?', (self.instance_id,))
+        except Exception as e:
+            logger.error(f"Error soltando el lease: {e}")
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+def release():
+    """Soltar el lease del coordinador del proceso, si ya se creó"""
+    with _coordinator_lock:
+        coordinator = _coordinator
+    if coordinator is not None:
+        coordinator.release()
+
+def get_coordinator():
+    """Coordinador compartido del proceso"""
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = Coordinator()
+            metrics.SCHEDULER_LEADER.set_function(lambda: int(_coordinator.is_leader()))
+        return _coordinator
@@ -0,0 +1,374 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import tracing
+import update_inbox
+from handlers import (
+    handle_start, handle_config, handle_status, handle_test,
+    handle_manual_in, handle_manual_out, handle_check_status, handle_exit, handle_message,
+    handle_users, handle_users_page, handle_rm, handle_report, handle_schedule, handle_profile
+)
+
+logger = logging.getLogger(__name__)
+
+# Hilos para ejecutar los comandos (las llamadas a Odoo son bloqueantes)
+COMMAND_WORKERS = int(os.environ.get('COMMAND_WORKERS', 16))
+# Segundos que se conserva la cola de un usuario inactivo
+USER_QUEUE_IDLE = 60
+# Cada cuántos comandos se registra la latencia en el log
+LATENCY_LOG_EVERY = 100
+# IDs de updates recientes que se recuerdan para descartar entregas repetidas
+RECENT_UPDATES = 1000
+# Segundos de espera cuando otra instancia está haciendo getUpdates con el mismo token
+POLL_CONFLICT_BACKOFF = 5
+# Cada cuántos segundos se renuevan los updates en curso y se recuperan los abandonados
+CLAIM_RENEW_INTERVAL = update_inbox.CLAIM_TTL / 3
+
+ALLOWED_USERS = []  # Lista vacía para permitir a todos los usuarios
+
+def is_user_allowed(user_id):
+    """Verifica si el usuario está permitido"""
+    if not ALLOWED_USERS:
+        return True  # Permitir a todos los usuarios si ALLOWED_USERS está vacío
+    return user_id in ALLOWED_USERS
+
+# Comandos conocidos; el resto se agrupa en 'unknown' para no crear una serie de métricas por texto
+COMMANDS = frozenset((
+    '/start', '/config', '/status', '/test', '/manual_in', '/manual_out', '/check_status',
+    '/report', '/schedule', '/exit', '/users', '/rm', '/profile'
+))
+
+def command_name(text):
+    """Nombre del comando de un mensaje ('/status', '/rm', ...), 'unknown' o 'message' si es texto libre"""
+    if text.startswith('/'):
+        command = text.split()[0]
+        return command if command in COMMANDS else 'unknown'
+    return 'message'
+
+def dispatch_update(bot, update):
+    """Procesar un update de Telegram llamando al handler que corresponda"""
+    if 'callback_query' in update:
+        _dispatch_callback(bot, update['callback_query'])
+        return
+
+    if 'message' not in update:
+        return
+
+    message = update['message']
+    chat_id = message['chat']['id']
+    user_id = message['from']['id']
+
+    if not is_user_allowed(user_id):
+        bot.send_message(chat_id, "❌ Lo siento, este bot está limitado a usuarios autorizados.")
+        return
+
+    if 'text' not in message:
+        return
+
+    text = message['text']
+
+    command = command_name(text)
+    tracing.tag(command=command)
+    with metrics.COMMAND_DURATION.time(command=command), tracing.span('dispatch'):
+        _dispatch_text(bot, chat_id, user_id, text)
+
+def _dispatch_text(bot, chat_id, user_id, text):
+    try:
+        if text == '/start':
+            handle_start(bot, chat_id, user_id)
+        elif text == '/config':
+            handle_config(bot, chat_id, user_id)
+        elif text == '/status':
+            handle_status(bot, chat_id, user_id)
+        elif text == '/test':
+            handle_test(bot, chat_id, user_id)
+        elif text == '/manual_in':
+            handle_manual_in(bot, chat_id, user_id)
+        elif text == '/manual_out':
+            handle_manual_out(bot, chat_id, user_id)
+        elif text == '/check_status':
+            handle_check_status(bot, chat_id, user_id)
+        elif text == '/report' or text.startswith('/report '):
+            handle_report(bot, chat_id, user_id, text.split()[1:])
+        elif text == '/schedule' or text.startswith('/schedule '):
+            handle_schedule(bot, chat_id, user_id, text[len('/schedule'):])
+        elif text == '/exit':
+            handle_exit(bot, chat_id, user_id)
+        elif text == '/users' or text.startswith('/users '):
+            parts = text.split()
+            page = int(parts[1]) - 1 if len(parts) == 2 and parts[1].isdigit() else 0
+            handle_users(bot, chat_id, user_id, page)
+        elif text == '/profile' or text.startswith('/profile '):
+            handle_profile(bot, chat_id, user_id, text.split()[1:])
+        elif text.startswith('/rm'):
+            parts = text.split()
+            if len(parts) == 2:
+                username = parts[1]
+                handle_rm(bot, chat_id, user_id, username)
+            else:
+                bot.send_message(chat_id, "Uso: /rm <username>")
+        elif not text.startswith('/'):
+            handle_message(bot, chat_id, user_id, text)
+    except Exception as e:
+        logger.error(f"Error procesando mensaje: {e}")
+
+def _dispatch_callback(bot, callback):
+    """Pulsación de un botón inline"""
+    message = callback.get('message')
+    if not message:
+        return
+
+    chat_id = message['chat']['id']
+    user_id = callback['from']['id']
+    data = callback.get('data') or ''
+
+    if not is_user_allowed(user_id):
+        bot.answer_callback_query(chat_id, callback['id'], "❌ Usuario no autorizado")
+        return
+
+    # Se responde primero para que Telegram quite el indicador de carga del botón
+    bot.answer_callback_query(chat_id, callback['id'])
+    name = 'callback:users' if data.startswith('users:') else 'callback'
+    tracing.tag(command=name)
+    with metrics.COMMAND_DURATION.time(command=name), tracing.span('dispatch'):
+        try:
+            page = data[len('users:'):]
+            if name == 'callback:users' and page.isdigit():
+                handle_users_page(bot, chat_id, message['message_id'], user_id, int(page))
+        except Exception as e:
+            logger.error(f"Error procesando botón: {e}")
+
+def update_user_key(update):
+    """Clave para serializar los updates de un mismo usuario"""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update and 'from' in update[kind]:
+            return update[kind]['from']['id']
+    return None
+
+class LatencyWindow:
+    """Ventana deslizante con las últimas latencias de comandos para calcular percentiles"""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, p):
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99)
+        }
+
+class UpdateLoop:
+    """Bucle asyncio de updates: usuarios distintos en paralelo, cada usuario en orden"""
+
+    def __init__(self, bot, workers=COMMAND_WORKERS, on_first_handled=None):
+        self.bot = bot
+        # Se llama una vez al terminar el primer comando (tiempo de arranque)
+        self.on_first_handled = on_first_handled
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='command')
+        # Hilo propio para el long polling, para no ocupar los de comandos
+        self.poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poll')
+        self.latencies = LatencyWindow()
+        self.loop = None
+        self._queues = {}
+        self._recent = deque(maxlen=RECENT_UPDATES)
+        self._recent_ids = set()
+        self._recent_lock = threading.Lock()
+
+    def _accept(self, updates):
+        """Quitar los updates repetidos y los demasiado antiguos (se avisa al usuario)"""
+        fresh = []
+        now = time.time()
+        with self._recent_lock:
+            for update in updates:
+                update_id = update['update_id']
+                if update_id in self._recent_ids:
+                    continue
+                if len(self._recent) == self._recent.maxlen:
+                    self._recent_ids.discard(self._recent[0])
+                self._recent.append(update_id)
+                self._recent_ids.add(update_id)
+                if update_inbox.is_stale(update, now):
+                    self._reject_stale(update, now)
+                else:
+                    fresh.append(update)
+        return fresh
+
+    def _reject_stale(self, update, now):
+        message = update.get('message') or update.get('edited_message') or {}
+        text = message.get('text', '')
+        age = int((now - update_inbox.update_date(update)) // 60)
+        logger.warning(f"Update {update['update_id']} descartado por antiguo ({age} min)")
+        if text.startswith('/') and 'chat' in message:
+            self.bot.send_message(
+                message['chat']['id'],
+                f"⚠️ Se ignoró tu comando {text.split()[0]} enviado hace {age} min porque llegó con "
+                f"demasiado retraso. Envíalo de nuevo si aún lo necesitas."
+            )
+
+    def resume(self):
+        """Continuar donde se quedó el proceso anterior: offset guardado y updates sin procesar"""
+        try:
+            self.bot.offset = update_inbox.load_offset()
+            pending = update_inbox.claim_abandoned()
+        except Exception as e:
+            logger.error(f"Error recuperando updates pendientes: {e}")
+            return
+        self._submit_recovered(pending)
+
+    def _submit_recovered(self, pending):
+        """Procesar updates abandonados por otra instancia o por un proceso anterior (ya reservados)"""
+        if not pending:
+            return
+        now = time.time()
+        for update in pending:
+            if update_inbox.is_stale(update, now):
+                update_inbox.done(update['update_id'])
+        fresh = self._accept(pending)
+        logger.info(f"Recuperados {len(fresh)} updates sin procesar (offset {self.bot.offset})")
+        for update in fresh:
+            self.submit(update)
+
+    async def _maintain_claims(self):
+        """Renovar la reserva de los updates en curso y recuperar los abandonados
+
+        Los que otra instancia viva tiene en curso siguen reservados por ella y no se repiten.
+        Se usa el executor por defecto: con todos los hilos de comandos ocupados la
+        renovación no debe retrasarse hasta que caduque la reserva.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CLAIM_RENEW_INTERVAL)
+            try:
+                await loop.run_in_executor(None, update_inbox.renew)
+                pending = await loop.run_in_executor(None, update_inbox.claim_abandoned)
+            except Exception as e:
+                logger.error(f"Error renovando los updates en curso: {e}")
+                continue
+            self._submit_recovered(pending)
+
+    def submit(self, update):
+        """Encolar un update en la cola de su usuario (debe llamarse desde el event loop)"""
+        key = update_user_key(update)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[key] = queue
+            asyncio.get_running_loop().create_task(self._user_worker(key, queue))
+        queue.put_nowait((update, time.monotonic()))
+
+    def submit_threadsafe(self, update):
+        """Guardar y encolar un update desde otro hilo (webhook). Devuelve False si el bucle aún no arrancó"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return False
+        fresh = update_inbox.record(self._accept([update]))
+        for update in fresh:
+            loop.call_soon_threadsafe(self.submit, update)
+        return True
+
+    def _handle(self, update, received):
+        # La traza empieza al recibir el update: el primer span es la espera en la cola del usuario
+        with tracing.trace('update', start=received, update_id=update['update_id'],
+                           user_id=update_user_key(update)) as current_trace:
+            if current_trace is not None:
+                current_trace.add_span('queue', received, time.monotonic() - received)
+            dispatch_update(self.bot, update)
+        try:
+            update_inbox.done(update['update_id'])
+        except Exception as e:
+            logger.error(f"Error marcando el update {update['update_id']} como procesado: {e}")
+
+    async def _user_worker(self, key, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                update, received = await asyncio.wait_for(queue.get(), USER_QUEUE_IDLE)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self._queues[key]
+                    return
+                continue
+
+            await loop.run_in_executor(self.executor, self._handle, update, received)
+            self.latencies.record(time.monotonic() - received)
+            if self.on_first_handled:
+                callback, self.on_first_handled = self.on_first_handled, None
+                callback()
+            if self.latencies.count % LATENCY_LOG_EVERY == 0:
+                stats = self.latencies.stats()
+                logger.info(
+                    f"Latencia de comandos: p50={stats['p50'] * 1000:.0f}ms "
+                    f"p99={stats['p99'] * 1000:.0f}ms ({stats['count']} comandos)"
+                )
+
+    async def poll(self):
+        """Long polling de getUpdates; cada update se reparte a la cola de su usuario"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                updates = await loop.run_in_executor(self.poll_executor, self.bot.get_updates)
+
+                if updates and updates.get('error_code') == 409:
+                    description = updates.get('description', '')
+                    if 'webhook' in description.lower():
+                        # Quedó registrado un webhook de un arranque anterior: quitarlo para usar polling
+                        await loop.run_in_executor(self.poll_executor, self.bot.delete_webhook)
+                        continue
+                    # "terminated by other getUpdates request": otra instancia hace polling
+                    logger.warning(f"Conflicto en getUpdates: {description}")
+                    await asyncio.sleep(POLL_CONFLICT_BACKOFF)
+                    continue
+
+                if not updates or not updates.get('ok'):
+                    await asyncio.sleep(1)
+                    continue
+
+                result = updates.get('result', [])
+                if not result:
+                    continue
+
+                # Guardar el lote y el offset antes de confirmarlo a Telegram en el siguiente getUpdates
+                offset = result[-1]['update_id'] + 1
+                fresh = await loop.run_in_executor(self.poll_executor, update_inbox.record,
+                                                   self._accept(result), offset)
+                self.bot.offset = offset
+                for update in fresh:
+                    self.submit(update)
+
+            except Exception as e:
+                logger.error(f"Error en loop principal: {e}")
+                await asyncio.sleep(5)
+
+    def run(self, webhook=False):
+        """Ejecutar el bucle de updates hasta que se detenga el proceso
+
+        En modo webhook no se hace polling: los updates llegan por submit_threadsafe.
+        """
+        asyncio.run(self._main(webhook))
+
+    async def _main(self, webhook):
+        self.loop = asyncio.get_running_loop()
+        self.resume()
+        self.loop.create_task(self._maintain_claims())
+        if webhook:
+            await asyncio.Event().wait()
+        else:
+            await self.poll()
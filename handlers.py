@@ -1,49 +1,80 @@
-import logging
-import json
 import os
+import html
+import logging
 import pytz
 from datetime import datetime
-from odoo_api import OdooAPI
+import storage
+import metrics
+import reports
+import attendance_cache
+import schedules
+import profiler
+from user_registry import UserRegistry
+from odoo_api import OdooAPI, invalidate_session
 
 logger = logging.getLogger(__name__)
 
-# Archivo para persistencia
+# Archivo JSON antiguo; se migra una sola vez al almacén SQLite
 PERSISTENCE_FILE = "user_data.json"
 
+# Usuarios por página en /users (cada página queda muy por debajo del límite de 4096 caracteres)
+USERS_PAGE_SIZE = 20
+# Longitud máxima de cada campo mostrado en /users
+USERS_FIELD_MAX = 60
+
+# IDs de Telegram de los administradores, separados por comas (pueden usar /profile)
+ADMIN_USER_IDS = {int(x) for x in os.environ.get('ADMIN_USER_IDS', '').replace(' ', '').split(',') if x}
+
 # Almacenamiento temporal de configuraciones de usuario
-user_configs = {}
+user_configs = UserRegistry()
 user_states = {}
 
+_writer = None
+
+metrics.CONFIGURED_USERS.set_function(lambda: len(user_configs))
+metrics.USERS_IN_SETUP.set_function(lambda: len(user_states))
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = storage.register_writer(storage.WriteBehind(storage.get_store(), user_configs, user_states))
+    return _writer
+
 # Cargar datos persistentes
 def load_persistent_data():
-    global user_configs, user_states
+    """Cargar usuarios y estados del almacén (se actualizan los dicts existentes en el sitio)"""
     try:
-        if os.path.exists(PERSISTENCE_FILE):
-            with open(PERSISTENCE_FILE, 'r') as f:
-                data = json.load(f)
-                user_configs = data.get('user_configs', {})
-                user_states = data.get('user_states', {})
-                logger.info("Datos persistentes cargados correctamente")
+        store = storage.get_store()
+        store.migrate_json(PERSISTENCE_FILE)
+        configs, states = store.load()
+        user_configs.clear()
+        user_configs.update(configs)
+        user_states.clear()
+        user_states.update(states)
+        schedules.index.rebuild(user_configs)
+        logger.info("Datos persistentes cargados correctamente")
     except Exception as e:
         logger.error(f"Error cargando datos persistentes: {e}")
-        user_configs = {}
-        user_states = {}
+        user_configs.clear()
+        user_states.clear()
 
 # Guardar datos persistentes
-def save_persistent_data():
-    try:
-        data = {
-            'user_configs': user_configs,
-            'user_states': user_states
-        }
-        with open(PERSISTENCE_FILE, 'w') as f:
-            json.dump(data, f)
-        logger.info("Datos persistentes guardados correctamente")
-    except Exception as e:
-        logger.error(f"Error guardando datos persistentes: {e}")
+def save_persistent_data(*user_ids):
+    """Guardar los registros de los usuarios indicados (todos si no se indica ninguno)
 
-# Cargar datos al importar el módulo
-load_persistent_data()
+    Los cambios se agrupan y se escriben en segundo plano en una sola transacción.
+    """
+    if not user_ids:
+        user_ids = set(user_configs) | set(user_states)
+    for user_id in user_ids:
+        user_configs.reindex(user_id)
+        schedules.index.update(user_id, user_configs.get(user_id))
+    _get_writer().mark(user_ids)
+
+def forget_session(config):
+    """Descartar la sesión de Odoo cacheada para una configuración de usuario"""
+    if config and all(key in config for key in ('url', 'db', 'username')):
+        invalidate_session(config['url'], config['db'], config['username'])
 
 def handle_start(bot, chat_id, user_id):
     """Comando /start"""
@@ -57,6 +88,8 @@ def handle_start(bot, chat_id, user_id):
             "/manual_in - Marcar entrada manual\n"
             "/manual_out - Marcar salida manual\n"
             "/check_status - Ver si tienes asistencia abierta\n"
+            "/report [week|month] - Ver horas trabajadas\n"
+            "/schedule - Ver o cambiar tu horario\n"
             "/exit - Borrar configuración y empezar de nuevo\n"
             "/users - Listar usuarios configurados\n"
             "/rm <username> - Eliminar un usuario"
@@ -72,8 +105,9 @@ def handle_start(bot, chat_id, user_id):
 
 def handle_config(bot, chat_id, user_id):
     """Iniciar configuración de Odoo"""
+    forget_session(user_configs.get(user_id))
     user_states[user_id] = "waiting_url"
-    save_persistent_data()  # Guardar estado inmediatamente
+    save_persistent_data(user_id)  # Guardar estado inmediatamente
     
     text = (
         "🔧 Configuración de Odoo\n\n"
@@ -91,19 +125,18 @@ def handle_status(bot, chat_id, user_id):
     config = user_configs[user_id]
     
     # Obtener información de asistencia
-    attendance_status = "🔄 Verificando estado de asistencia..."
-    bot.send_message(chat_id, attendance_status)
+    progress = bot.progress(chat_id, "🔄 Verificando estado de asistencia...")
     
     odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
     
     if odoo.authenticate():
         employee_id = odoo.get_employee_id()
         if employee_id:
-            # Obtener asistencia abierta
-            open_attendance = odoo.get_open_attendance(employee_id)
-            
-            # Obtener última asistencia cerrada
-            last_attendance = odoo.get_last_attendance(employee_id)
+            # Asistencia abierta, última salida y horas de hoy desde el espejo local (se sincroniza si está desactualizado)
+            status = attendance_cache.get_status(odoo, employee_id)
+            open_attendance = status['open']
+            last_closed = status['last_closed']
+            today = f"⏱️ Horas de hoy: {reports.format_hours(status['today_hours'])}"
             
             if open_attendance:
                 cuba_tz = pytz.timezone('America/Havana')
@@ -117,11 +150,12 @@ def handle_status(bot, chat_id, user_id):
                     f"✅ Tienes una asistencia ABIERTA\n"
                     f"🕐 Hora de entrada: {check_in_cuba.strftime('%H:%M:%S')}\n"
                     f"📅 Fecha: {check_in_cuba.strftime('%d/%m/%Y')}\n"
-                    f"⏱️ Tiempo trabajado: {datetime.now(cuba_tz) - check_in_cuba}"
+                    f"⏱️ Tiempo trabajado: {datetime.now(cuba_tz) - check_in_cuba}\n"
+                    f"{today}"
                 )
-            elif last_attendance and last_attendance.get('check_out'):
+            elif last_closed:
                 cuba_tz = pytz.timezone('America/Havana')
-                check_out_str = last_attendance['check_out']
+                check_out_str = last_closed['check_out']
                 check_out_utc = datetime.strptime(check_out_str, '%Y-%m-%d %H:%M:%S')
                 check_out_utc = pytz.utc.localize(check_out_utc)
                 check_out_cuba = check_out_utc.astimezone(cuba_tz)
@@ -130,7 +164,8 @@ def handle_status(bot, chat_id, user_id):
                     f"📊 Estado de asistencia:\n"
                     f"❌ No tienes asistencia abierta\n"
                     f"🕐 Última salida: {check_out_cuba.strftime('%H:%M:%S')}\n"
-                    f"📅 Fecha: {check_out_cuba.strftime('%d/%m/%Y')}"
+                    f"📅 Fecha: {check_out_cuba.strftime('%d/%m/%Y')}\n"
+                    f"{today}"
                 )
             else:
                 attendance_info = (
@@ -150,10 +185,9 @@ def handle_status(bot, chat_id, user_id):
         f"🔑 Contraseña: {'*' * len(config['password'])}\n\n"
         f"{attendance_info}\n\n"
         f"⏰ Horarios programados:\n"
-        f"📅 Lunes a Jueves: 8:00 AM - 5:30 PM\n"
-        f"📅 Viernes: 8:00 AM - 4:30 PM"
+        f"{schedules.format_schedule(config)}"
     )
-    bot.send_message(chat_id, text)
+    progress.finish(text)
 
 def handle_test(bot, chat_id, user_id):
     """Probar conexión con Odoo"""
@@ -161,7 +195,7 @@ def handle_test(bot, chat_id, user_id):
         bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
         return
     
-    bot.send_message(chat_id, "🔄 Probando conexión con Odoo...")
+    progress = bot.progress(chat_id, "🔄 Probando conexión con Odoo...")
     
     config = user_configs[user_id]
     odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
@@ -175,7 +209,7 @@ def handle_test(bot, chat_id, user_id):
     else:
         text = "❌ Error de conexión."
     
-    bot.send_message(chat_id, text)
+    progress.finish(text)
 
 def handle_manual_in(bot, chat_id, user_id):
     """Marcar entrada manual"""
@@ -183,7 +217,7 @@ def handle_manual_in(bot, chat_id, user_id):
         bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
         return
     
-    bot.send_message(chat_id, "🔄 Marcando entrada...")
+    progress = bot.progress(chat_id, "🔄 Marcando entrada...")
     
     config = user_configs[user_id]
     odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
@@ -203,7 +237,7 @@ def handle_manual_in(bot, chat_id, user_id):
     else:
         text = "❌ Error de conexión."
     
-    bot.send_message(chat_id, text)
+    progress.finish(text)
 
 def handle_manual_out(bot, chat_id, user_id):
     """Marcar salida manual"""
@@ -211,7 +245,7 @@ def handle_manual_out(bot, chat_id, user_id):
         bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
         return
     
-    bot.send_message(chat_id, "🔄 Marcando salida...")
+    progress = bot.progress(chat_id, "🔄 Marcando salida...")
     
     config = user_configs[user_id]
     odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
@@ -231,7 +265,7 @@ def handle_manual_out(bot, chat_id, user_id):
     else:
         text = "❌ Error de conexión."
     
-    bot.send_message(chat_id, text)
+    progress.finish(text)
 
 def handle_check_status(bot, chat_id, user_id):
     """Verificar si hay asistencia abierta y desde qué hora"""
@@ -239,7 +273,7 @@ def handle_check_status(bot, chat_id, user_id):
         bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
         return
     
-    bot.send_message(chat_id, "🔄 Verificando estado de asistencia...")
+    progress = bot.progress(chat_id, "🔄 Verificando estado de asistencia...")
     
     config = user_configs[user_id]
     odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
@@ -247,7 +281,9 @@ def handle_check_status(bot, chat_id, user_id):
     if odoo.authenticate():
         employee_id = odoo.get_employee_id()
         if employee_id:
-            open_attendance = odoo.get_open_attendance(employee_id)
+            status = attendance_cache.get_status(odoo, employee_id)
+            open_attendance = status['open']
+            today = f"⏱️ Horas de hoy: {reports.format_hours(status['today_hours'])}"
             if open_attendance:
                 cuba_tz = pytz.timezone('America/Havana')
                 check_in_str = open_attendance['check_in']
@@ -259,19 +295,83 @@ def handle_check_status(bot, chat_id, user_id):
                     f"✅ Tienes una asistencia abierta\n\n"
                     f"🕐 Hora de entrada: {check_in_cuba.strftime('%H:%M:%S')}\n"
                     f"📅 Fecha: {check_in_cuba.strftime('%d/%m/%Y')}\n"
-                    f"⏱️ Tiempo trabajado: {datetime.now(cuba_tz) - check_in_cuba}"
+                    f"⏱️ Tiempo trabajado: {datetime.now(cuba_tz) - check_in_cuba}\n"
+                    f"{today}"
                 )
             else:
                 text = (
-                    "❌ No tienes ninguna asistencia abierta\n\n"
-                    "Puedes marcar entrada con /manual_in"
+                    f"❌ No tienes ninguna asistencia abierta\n"
+                    f"{today}\n\n"
+                    f"Puedes marcar entrada con /manual_in"
                 )
         else:
             text = "❌ No se encontró empleado asociado."
     else:
         text = "❌ Error de conexión."
     
-    bot.send_message(chat_id, text)
+    progress.finish(text)
+
+def handle_report(bot, chat_id, user_id, args):
+    """Resumen de horas trabajadas: /report [week|month|AAAA-MM-DD AAAA-MM-DD]"""
+    if user_id not in user_configs:
+        bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
+        return
+
+    period = reports.parse_period(args)
+    if not period:
+        bot.send_message(chat_id, "Uso: /report [week|month|AAAA-MM-DD AAAA-MM-DD]")
+        return
+    start, end, title = period
+
+    progress = bot.progress(chat_id, "🔄 Calculando horas trabajadas...")
+
+    config = user_configs[user_id]
+    odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
+
+    if odoo.authenticate():
+        employee_id = odoo.get_employee_id()
+        if employee_id:
+            try:
+                attendances = odoo.iter_attendances(employee_id, reports.to_odoo_utc(start),
+                                                    reports.to_odoo_utc(end))
+                daily, weekly, total = reports.aggregate_hours(attendances)
+                text = reports.format_report(title, daily, weekly, total)
+            except Exception as e:
+                logger.error(f"Error generando informe para usuario {user_id}: {e}")
+                text = "❌ Error obteniendo las asistencias."
+        else:
+            text = "❌ No se encontró empleado asociado."
+    else:
+        text = "❌ Error de conexión."
+
+    progress.finish(text)
+
+def handle_schedule(bot, chat_id, user_id, args):
+    """Ver o cambiar el horario de marcado automático: /schedule [entrada salida [días]; ...]"""
+    if user_id not in user_configs:
+        bot.send_message(chat_id, "❌ No tienes configuración guardada. Usa /config para configurar.")
+        return
+
+    config = user_configs[user_id]
+    args = args.strip()
+    if not args:
+        text = f"⏰ Tu horario:\n{schedules.format_schedule(config)}\n\n{schedules.USAGE}"
+        bot.send_message(chat_id, text)
+        return
+
+    if args.lower() == 'default':
+        config.pop('schedule', None)
+    elif args.lower() == 'off':
+        config['schedule'] = []
+    else:
+        try:
+            config['schedule'] = schedules.parse_schedule(args)
+        except ValueError as e:
+            bot.send_message(chat_id, f"❌ {e}")
+            return
+
+    save_persistent_data(user_id)  # Guardar cambios y reindexar el horario
+    bot.send_message(chat_id, f"✅ Horario actualizado:\n{schedules.format_schedule(config)}")
 
 def handle_exit(bot, chat_id, user_id):
     """Borrar configuración del usuario y detener tareas programadas"""
@@ -279,12 +379,12 @@ def handle_exit(bot, chat_id, user_id):
         bot.send_message(chat_id, "❌ No tienes configuración guardada.")
         return
     
-    del user_configs[user_id]
+    forget_session(user_configs.pop(user_id))
     
     if user_id in user_states:
         del user_states[user_id]
     
-    save_persistent_data()  # Guardar cambios
+    save_persistent_data(user_id)  # Guardar cambios
     
     text = (
         "🗑️ Configuración eliminada exitosamente.\n\n"
@@ -295,40 +395,111 @@ def handle_exit(bot, chat_id, user_id):
     
     bot.send_message(chat_id, text)
 
-def handle_users(bot, chat_id, user_id):
-    """Listar todos los usuarios configurados en el bot"""
+def _users_field(value):
+    text = str(value)
+    if len(text) > USERS_FIELD_MAX:
+        text = text[:USERS_FIELD_MAX - 1] + '…'
+    return html.escape(text)
+
+def users_page(page=0):
+    """Texto y teclado inline de una página de /users"""
+    entries, page, pages = user_configs.page(page, USERS_PAGE_SIZE)
+    lines = [f"👥 Usuarios configurados: {len(user_configs)} (página {page + 1}/{pages})", ""]
+    for uid, config in entries:
+        lines.append(f"👤 Username: {_users_field(config.get('username', '-'))}")
+        lines.append(f"🌐 URL: {_users_field(config.get('url', '-'))}")
+        lines.append(f"🗄️ DB: {_users_field(config.get('db', '-'))}")
+        lines.append(f"🆔 User ID: {uid}")
+        lines.append("---")
+
+    buttons = []
+    if page > 0:
+        buttons.append({'text': '⬅️ Anterior', 'callback_data': f'users:{page - 1}'})
+    if page < pages - 1:
+        buttons.append({'text': 'Siguiente ➡️', 'callback_data': f'users:{page + 1}'})
+    reply_markup = {'inline_keyboard': [buttons]} if buttons else None
+    return "\n".join(lines), reply_markup
+
+def handle_users(bot, chat_id, user_id, page=0):
+    """Listar los usuarios configurados en el bot, por páginas"""
     if not user_configs:
         bot.send_message(chat_id, "No hay usuarios configurados.")
         return
 
-    users_list = "👥 Usuarios configurados:\n\n"
-    for uid, config in user_configs.items():
-        users_list += f"👤 Username: {config['username']}\n"
-        users_list += f"🌐 URL: {config['url']}\n"
-        users_list += f"🗄️ DB: {config['db']}\n"
-        users_list += f"🆔 User ID: {uid}\n"
-        users_list += "---\n"
+    text, reply_markup = users_page(page)
+    bot.send_message(chat_id, text, reply_markup)
 
-    bot.send_message(chat_id, users_list)
+def handle_users_page(bot, chat_id, message_id, user_id, page):
+    """Botones de navegación de /users: editar el mensaje con la página pedida"""
+    if not user_configs:
+        bot.edit_message_text(chat_id, message_id, "No hay usuarios configurados.")
+        return
+
+    text, reply_markup = users_page(page)
+    bot.edit_message_text(chat_id, message_id, text, reply_markup)
 
 def handle_rm(bot, chat_id, user_id, username):
     """Eliminar un usuario por su username"""
-    # Buscar el user_id por username
-    found = False
-    for uid, config in user_configs.items():
-        if config['username'] == username:
-            # Eliminar el usuario
-            del user_configs[uid]
-            if uid in user_states:
-                del user_states[uid]
-            found = True
-            break
-
-    if found:
-        save_persistent_data()  # Guardar cambios
-        bot.send_message(chat_id, f"✅ Usuario {username} eliminado correctamente.")
-    else:
+    matches = user_configs.find_by_username(username)
+    if not matches:
         bot.send_message(chat_id, f"❌ No se encontró el usuario {username}.")
+        return
+
+    found = matches[0]
+    forget_session(user_configs.pop(found))
+    user_states.pop(found, None)
+    save_persistent_data(found)  # Guardar cambios
+
+    text = f"✅ Usuario {username} eliminado correctamente."
+    if len(matches) > 1:
+        text += f"\nQuedan {len(matches) - 1} usuario(s) más con ese username."
+    bot.send_message(chat_id, text)
+
+PROFILE_USAGE = (
+    "Uso:\n"
+    "/profile [segundos] [bot|scheduler|all] - muestrear los hilos y recibir las pilas (collapsed)\n"
+    "/profile check_in|check_out - perfilar con cProfile la próxima marca programada (pstats)"
+)
+
+def handle_profile(bot, chat_id, user_id, args):
+    """Perfilado bajo demanda (solo administradores)"""
+    if user_id not in ADMIN_USER_IDS:
+        bot.send_message(chat_id, "❌ Comando solo disponible para administradores.")
+        return
+
+    if args and args[0] in ('check_in', 'check_out'):
+        action = args[0]
+
+        def deliver(summary, stats):
+            caption = (f"⏱️ Perfil de la {action} programada: {summary['users']} usuarios, "
+                       f"{summary['elapsed']:.1f}s")
+            bot.send_document(chat_id, f"{action}.pstats", profiler.dump_stats(stats), caption)
+
+        profiler.arm(action, deliver)
+        bot.send_message(chat_id, f"✅ Se perfilará la próxima ejecución de {action}. Recibirás el archivo pstats.")
+        return
+
+    seconds = 10
+    target = 'all'
+    for arg in args:
+        if arg.isdigit():
+            seconds = int(arg)
+        elif arg in profiler.THREAD_GROUPS or arg == 'all':
+            target = arg
+        else:
+            bot.send_message(chat_id, PROFILE_USAGE)
+            return
+
+    bot.send_message(chat_id, f"⏱️ Muestreando '{target}' durante {seconds}s...")
+    try:
+        collapsed = profiler.sample(seconds, target)
+    except profiler.ProfilerBusy:
+        bot.send_message(chat_id, "❌ Ya hay un perfilado en curso.")
+        return
+
+    filename = f"profile-{target}-{datetime.now(reports.CUBA_TZ).strftime('%Y%m%d-%H%M%S')}.txt"
+    bot.send_document(chat_id, filename, collapsed.encode('utf-8'),
+                      "Pilas en formato collapsed (flamegraph.pl o speedscope)")
 
 def handle_message(bot, chat_id, user_id, text):
     """Manejar mensajes durante la configuración"""
@@ -358,30 +529,30 @@ def handle_message(bot, chat_id, user_id, text):
             user_configs[user_id] = {}
         user_configs[user_id]['url'] = text.rstrip('/')
         user_states[user_id] = "waiting_db"
-        save_persistent_data()  # Guardar estado
+        save_persistent_data(user_id)  # Guardar estado
         
         bot.send_message(chat_id, "✅ URL guardada.\n\nAhora envía el nombre de tu base de datos:")
     
     elif state == "waiting_db":
         user_configs[user_id]['db'] = text
         user_states[user_id] = "waiting_username"
-        save_persistent_data()  # Guardar estado
+        save_persistent_data(user_id)  # Guardar estado
         
         bot.send_message(chat_id, "✅ Base de datos guardada.\n\nAhora envía tu nombre de usuario de Odoo:")
     
     elif state == "waiting_username":
         user_configs[user_id]['username'] = text
         user_states[user_id] = "waiting_password"
-        save_persistent_data()  # Guardar estado
+        save_persistent_data(user_id)  # Guardar estado
         
         bot.send_message(chat_id, "✅ Usuario guardado.\n\nPor último, envía tu contraseña de Odoo:")
     
     elif state == "waiting_password":
         user_configs[user_id]['password'] = text
         del user_states[user_id]
-        save_persistent_data()  # Guardar estado
+        save_persistent_data(user_id)  # Guardar estado
         
-        bot.send_message(chat_id, "✅ ¡Configuración completada!\n\nProbando conexión...")
+        progress = bot.progress(chat_id, "✅ ¡Configuración completada!\n\nProbando conexión...")
         
         config = user_configs[user_id]
         odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
@@ -392,8 +563,8 @@ def handle_message(bot, chat_id, user_id, text):
                 text = (
                     "🎉 ¡Todo configurado correctamente!\n\n"
                     "El bot marcará automáticamente:\n"
-                    "📅 Lunes a Jueves: 8:00 AM - 5:30 PM\n"
-                    "📅 Viernes: 8:00 AM - 4:30 PM\n\n"
+                    f"{schedules.format_schedule(config)}\n\n"
+                    "Usa /schedule para cambiar tu horario.\n\n"
                     "También puedes usar los comandos manuales:\n"
                     "/manual_in - Marcar entrada\n"
                     "/manual_out - Marcar salida\n"
@@ -411,6 +582,6 @@ def handle_message(bot, chat_id, user_id, text):
         else:
             text = "❌ Error de conexión. Verifica tus credenciales y usa /config para reconfigurar."
             del user_configs[user_id]
-            save_persistent_data()  # Guardar cambios
+            save_persistent_data(user_id)  # Guardar cambios
         
-        bot.send_message(chat_id, text)
\ No newline at end of file
+        progress.finish(text)
\ No newline at end of file
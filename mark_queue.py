@@ -0,0 +1,100 @@
+import os
+import time
+import random
+import logging
+import storage
+from coordination import INSTANCE_ID
+
+logger = logging.getLogger(__name__)
+
+# Reintentos de marcas programadas fallidas: backoff exponencial con jitter
+MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 6))
+BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 30))
+MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 900))
+# Una marca pendiente más antigua que esto ya no tiene sentido (p. ej. la entrada de ayer)
+MAX_AGE = float(os.environ.get('RETRY_MAX_AGE', 4 * 3600))
+# Segundos tras los que una marca reservada por una instancia se da por abandonada (debe
+# superar lo que dura una ejecución, ventana incluida)
+CLAIM_TTL = float(os.environ.get('RETRY_CLAIM_TTL', 600))
+
+def backoff(attempts):
+    """Segundos hasta el siguiente intento: exponencial con jitter completo"""
+    delay = min(MAX_DELAY, BASE_DELAY * 2 ** max(0, attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+def enqueue(run_key, action, user_ids):
+    """Registrar las marcas de una ejecución antes de empezarla (sin reservar; ver claim)"""
+    now = time.time()
+    storage.get_store().transaction([
+        ('INSERT OR IGNORE INTO scheduled_marks (run_key, user_id, action, attempts, next_attempt, created) '
+         'VALUES (?, ?, ?, 0, ?, ?)', (run_key, user_id, action, now, now))
+        for user_id in user_ids
+    ])
+
+def claim(run_key, user_ids, chunk_size=500):
+    """Reservar para esta instancia las marcas de `user_ids` que están vencidas y libres
+
+    Una marca está libre si nadie la reservó o si su reserva caducó (CLAIM_TTL). La
+    reserva es atómica (UPDATE ... WHERE), así que dos instancias nunca ejecutan la
+    misma marca. Devuelve los user_id reservados.
+    """
+    store = storage.get_store()
+    now = time.time()
+    user_ids = list(user_ids)
+    claimed = []
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        rows = store.execute(
+            f"UPDATE scheduled_marks SET claimed_by = ?, claimed_at = ? WHERE run_key = ? AND next_attempt <= ? "
+            f"AND (claimed_by = '' OR claimed_at < ?) "
+            f"AND user_id IN ({', '.join('?' * len(chunk))}) RETURNING user_id",
+            (INSTANCE_ID, now, run_key, now, now - CLAIM_TTL, *chunk)
+        )
+        claimed.extend(user_id for user_id, in rows)
+    return claimed
+
+def complete(run_key, user_id):
+    storage.get_store().execute('DELETE FROM scheduled_marks WHERE run_key = ? AND user_id = ?',
+                                (run_key, user_id))
+
+def fail(run_key, user_id, attempts, error=None):
+    """Programar el siguiente intento. Devuelve el instante del reintento o None si se descarta"""
+    store = storage.get_store()
+    if attempts >= MAX_ATTEMPTS:
+        store.execute('DELETE FROM scheduled_marks WHERE run_key = ? AND user_id = ?', (run_key, user_id))
+        logger.error(f"Marca {run_key} descartada para usuario {user_id} tras {attempts} intentos")
+        return None
+    next_attempt = time.time() + backoff(attempts)
+    store.execute("UPDATE scheduled_marks SET attempts = ?, next_attempt = ?, last_error = ?, "
+                  "claimed_by = '', claimed_at = 0 WHERE run_key = ? AND user_id = ?",
+                  (attempts, next_attempt, error, run_key, user_id))
+    return next_attempt
+
+def due(limit=500):
+    """Marcas vencidas y libres: lista de (run_key, user_id, action, attempts)"""
+    store = storage.get_store()
+    now = time.time()
+    expired = store.execute('SELECT run_key, user_id FROM scheduled_marks WHERE created < ?', (now - MAX_AGE,))
+    if expired:
+        store.execute('DELETE FROM scheduled_marks WHERE created < ?', (now - MAX_AGE,))
+        logger.warning(f"Descartadas {len(expired)} marcas pendientes demasiado antiguas")
+    return store.execute("SELECT run_key, user_id, action, attempts FROM scheduled_marks "
+                         "WHERE next_attempt <= ? AND (claimed_by = '' OR claimed_at < ?) "
+                         "ORDER BY next_attempt LIMIT ?", (now, now - CLAIM_TTL, limit))
+
+def release_orphans():
+    """Liberar las marcas cuya reserva caducó (ejecución interrumpida) para reintentarlas
+
+    Solo se tocan las reservas caducadas: las de una ejecución que sigue en curso en otra
+    instancia y el backoff de los reintentos se respetan. Devuelve cuántas se liberaron.
+    """
+    rows = storage.get_store().execute(
+        "UPDATE scheduled_marks SET claimed_by = '', claimed_at = 0 "
+        "WHERE claimed_by != '' AND claimed_at < ? RETURNING user_id", (time.time() - CLAIM_TTL,)
+    )
+    if rows:
+        logger.warning(f"Liberadas {len(rows)} marcas de una ejecución interrumpida")
+    return len(rows)
+
+def pending_count():
+    return storage.get_store().execute('SELECT COUNT(*) FROM scheduled_marks')[0][0]
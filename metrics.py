@@ -0,0 +1,158 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Buckets por defecto (segundos) para latencias de red y de comandos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry.append(self)
+
+    def _label_values(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = {labels: self._snapshot(value) for labels, value in self._series.items()}
+        for labels, value in sorted(series.items()):
+            lines.extend(self._render_series(labels, value))
+        return lines
+
+    def _snapshot(self, value):
+        return value
+
+    def _render_series(self, labels, value):
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}']
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._label_values(labels)] = value
+
+    def set_function(self, function):
+        """Calcular el valor (sin etiquetas) en el momento de exportar"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception:
+                pass
+        return super().render()
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Conteo por bucket (no acumulado) + suma + total
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _render_series(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, ("le", _format_value(float(bound))))} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {count}')
+        return lines
+
+def render():
+    """Todas las métricas en formato de texto de Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+ODOO_RPC_DURATION = Histogram(
+    'odoo_rpc_duration_seconds', 'Duración de los métodos de OdooAPI', ('host', 'method'))
+ODOO_RPC_ERRORS = Counter(
+    'odoo_rpc_errors_total', 'Métodos de OdooAPI que terminaron en error', ('host', 'method'))
+ODOO_CIRCUIT_STATE = Gauge(
+    'odoo_circuit_state', 'Estado del circuito por host de Odoo (0 cerrado, 1 medio abierto, 2 abierto)', ('host',))
+TELEGRAM_REQUEST_DURATION = Histogram(
+    'telegram_request_duration_seconds', 'Duración de las llamadas a la API de Telegram', ('method',),
+    buckets=DEFAULT_BUCKETS + (45,))
+TELEGRAM_QUEUE_DEPTH = Gauge(
+    'telegram_outbound_queue_depth', 'Mensajes pendientes en la cola de envío')
+COMMAND_DURATION = Histogram(
+    'bot_command_duration_seconds', 'Duración de los comandos del bot', ('command',))
+SCHEDULER_JOB_DURATION = Histogram(
+    'scheduler_job_duration_seconds', 'Duración de las tareas programadas', ('job',),
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+SCHEDULED_MARKS = Counter(
+    'scheduled_marks_total', 'Marcas programadas por resultado', ('action', 'result'))
+SCHEDULED_USER_MARKS = Counter(
+    'scheduled_user_marks_total', 'Marcas programadas por usuario y resultado', ('action', 'user_id', 'result'))
+SCHEDULER_LEADER = Gauge(
+    'scheduler_leader', '1 si esta instancia es el líder del scheduler')
+CONFIGURED_USERS = Gauge(
+    'bot_configured_users', 'Usuarios con configuración guardada')
+USERS_IN_SETUP = Gauge(
+    'bot_users_in_setup', 'Usuarios en medio de /config')
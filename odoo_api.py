@@ -1,98 +1,207 @@
+import os
+import time
 import logging
+import functools
+import threading
 import xmlrpc.client
 from datetime import datetime
+from urllib.parse import urlparse
 import pytz
+import metrics
+import tracing
+import attendance_cache
+from odoo_transport import get_transport, get_json_transport, JsonRpcProxy
 
 logger = logging.getLogger(__name__)
 
+# Protocolo por defecto para hablar con Odoo: 'xmlrpc' o 'jsonrpc'
+DEFAULT_PROTOCOL = os.environ.get('ODOO_PROTOCOL', 'xmlrpc')
+PROTOCOLS = ('xmlrpc', 'jsonrpc')
+
+# Asistencias recientes que trae la consulta de estado (basta con cubrir las de hoy)
+STATUS_LIMIT = 20
+
+# Caché de sesiones por (url, db, username): uid y employee_id
+SESSION_TTL = int(os.environ.get('ODOO_SESSION_TTL', 3600))
+
+_session_cache = {}
+_session_lock = threading.Lock()
+
+def _session_key(url, db, username):
+    return (url.rstrip('/'), db, username)
+
+def get_cached_session(url, db, username, password):
+    """Obtener la sesión cacheada si existe, no ha expirado y la contraseña coincide"""
+    key = _session_key(url, db, username)
+    with _session_lock:
+        entry = _session_cache.get(key)
+        if not entry:
+            return None
+        if entry['password'] != password or time.monotonic() - entry['created'] > SESSION_TTL:
+            del _session_cache[key]
+            return None
+        return entry
+
+def _update_session(url, db, username, password, **values):
+    key = _session_key(url, db, username)
+    with _session_lock:
+        entry = _session_cache.get(key)
+        if not entry or entry['password'] != password:
+            entry = {'password': password, 'created': time.monotonic()}
+            _session_cache[key] = entry
+        entry.update(values)
+
+def invalidate_session(url, db, username):
+    """Eliminar la sesión cacheada (credenciales cambiadas o error de autenticación)"""
+    with _session_lock:
+        if _session_cache.pop(_session_key(url, db, username), None):
+            logger.info(f"Sesión invalidada para {username} en {db}")
+
+def _is_auth_error(error):
+    """Detectar si un error de Odoo se debe a credenciales inválidas o sesión caducada"""
+    if isinstance(error, xmlrpc.client.Fault):
+        return 'AccessDenied' in str(error.faultString) or 'Access Denied' in str(error.faultString)
+    return False
+
+def _instrumented(method):
+    """Registrar la duración y los errores de un método de OdooAPI por host (y un span si hay traza)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._failed = False
+        start = time.monotonic()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            self._failed = True
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            host = urlparse(self.url).netloc
+            metrics.ODOO_RPC_DURATION.observe(elapsed, host=host, method=method.__name__)
+            if self._failed:
+                metrics.ODOO_RPC_ERRORS.inc(host=host, method=method.__name__)
+            current_trace = tracing.current()
+            if current_trace is not None:
+                current_trace.add_span(f'odoo.{method.__name__}', start, elapsed,
+                                       'error' if self._failed else None, host=host)
+    return wrapper
+
 class OdooAPI:
-    def __init__(self, url, db, username, password):
+    def __init__(self, url, db, username, password, protocol=None):
         self.url = url.rstrip('/')
         self.db = db
         self.username = username
         self.password = password
+        self.protocol = protocol or DEFAULT_PROTOCOL
+        if self.protocol not in PROTOCOLS:
+            raise ValueError(f"Protocolo de Odoo no soportado: {self.protocol}")
         self.uid = None
         self.models = None
+        self._failed = False
+
+    def _server(self, service):
+        """Proxy del servicio de Odoo sobre el transporte con conexiones persistentes del host"""
+        if self.protocol == 'jsonrpc':
+            return JsonRpcProxy(get_json_transport(self.url), service)
+        return xmlrpc.client.ServerProxy(f'{self.url}/xmlrpc/2/{service}', transport=get_transport(self.url))
     
+    @_instrumented
     def authenticate(self):
-        """Autenticar con Odoo usando xmlrpc"""
+        """Autenticar con Odoo (reutiliza la sesión cacheada si existe)"""
+        session = get_cached_session(self.url, self.db, self.username, self.password)
+        if session and session.get('uid'):
+            self.uid = session['uid']
+            self.models = self._server('object')
+            return True
+
         try:
-            common = xmlrpc.client.ServerProxy(f'{self.url}/xmlrpc/2/common')
+            common = self._server('common')
             self.uid = common.authenticate(self.db, self.username, self.password, {})
             
             if self.uid:
-                self.models = xmlrpc.client.ServerProxy(f'{self.url}/xmlrpc/2/object')
+                self.models = self._server('object')
+                _update_session(self.url, self.db, self.username, self.password, uid=self.uid)
                 logger.info(f"Autenticación exitosa. UID: {self.uid}")
                 return True
             else:
+                self.invalidate_session()
                 logger.error("Credenciales inválidas")
                 return False
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error en autenticación: {e}")
             return False
+
+    def invalidate_session(self):
+        """Descartar la sesión cacheada de este usuario"""
+        invalidate_session(self.url, self.db, self.username)
+
+    def _cached(self, field):
+        session = get_cached_session(self.url, self.db, self.username, self.password)
+        if session and session.get('uid') == self.uid:
+            return session.get(field)
+        return None
+
+    def _handle_error(self, error):
+        """Invalidar la sesión cacheada si el error es de autenticación"""
+        self._failed = True
+        if _is_auth_error(error):
+            self.invalidate_session()
     
-    def get_partner_id(self):
-        """Obtener el partner_id del usuario autenticado"""
-        try:
-            user = self.models.execute_kw(self.db, self.uid, self.password, 
-                                        'res.users', 'read', [self.uid], 
-                                        {'fields': ['partner_id']})
-            
-            if user and user[0].get('partner_id'):
-                partner_id = user[0]['partner_id'][0]
-                logger.info(f"Partner ID obtenido: {partner_id}")
-                return partner_id
-            else:
-                logger.error("No se pudo obtener partner_id del usuario")
-                return None
-                
-        except Exception as e:
-            logger.error(f"Error obteniendo partner_id: {e}")
-            return None
-    
+    @_instrumented
     def get_employee_id(self):
-        """Obtener el ID del empleado asociado al partner_id del usuario"""
+        """Obtener el ID del empleado del usuario (por user_id o por su contacto de trabajo)"""
+        employee_id = self._cached('employee_id')
+        if employee_id:
+            return employee_id
+
         try:
-            partner_id = self.get_partner_id()
-            if not partner_id:
-                return None
-            
+            # Un solo dominio: empleados vinculados al usuario o cuyo contacto de trabajo es del usuario
             employees = self.models.execute_kw(self.db, self.uid, self.password,
                                              'hr.employee', 'search_read',
-                                             [[['work_contact_id', '=', partner_id]]],
-                                             {'fields': ['id', 'name']})
+                                             [['|', ['user_id', '=', self.uid],
+                                               ['work_contact_id.user_ids', 'in', [self.uid]]]],
+                                             {'fields': ['id', 'name'], 'limit': 1})
             
             if employees:
                 employee_id = employees[0]['id']
+                _update_session(self.url, self.db, self.username, self.password, employee_id=employee_id)
                 logger.info(f"Empleado encontrado: {employees[0]['name']} (ID: {employee_id})")
                 return employee_id
             else:
-                logger.error("No se encontró empleado asociado al partner_id")
+                logger.error("No se encontró empleado asociado al usuario")
                 return None
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error obteniendo empleado: {e}")
             return None
     
+    @_instrumented
     def create_attendance(self, employee_id):
         """Crear registro de asistencia (entrada)"""
         try:
             cuba_tz = pytz.timezone('America/Havana')
+            check_in = datetime.now(cuba_tz).strftime('%Y-%m-%d %H:%M:%S')
             attendance_id = self.models.execute_kw(self.db, self.uid, self.password,
                                                  'hr.attendance', 'create',
                                                  [{
                                                      'employee_id': employee_id,
-                                                     'check_in': datetime.now(cuba_tz).strftime('%Y-%m-%d %H:%M:%S')
+                                                     'check_in': check_in
                                                  }])
             
+            attendance_cache.record(self.url, self.db, employee_id,
+                                    {'id': attendance_id, 'check_in': check_in, 'check_out': False})
             logger.info(f"Asistencia creada exitosamente. ID: {attendance_id}")
             return True
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error creando asistencia: {e}")
             return False
     
+    @_instrumented
     def close_attendance(self, employee_id):
         """Cerrar registro de asistencia abierto (salida)"""
         try:
@@ -108,18 +217,23 @@ class OdooAPI:
                 return False
             
             attendance_id = attendances[0]['id']
+            check_out = datetime.now(cuba_tz).strftime('%Y-%m-%d %H:%M:%S')
             self.models.execute_kw(self.db, self.uid, self.password,
                                  'hr.attendance', 'write',
                                  [[attendance_id], 
-                                  {'check_out': datetime.now(cuba_tz).strftime('%Y-%m-%d %H:%M:%S')}])
+                                  {'check_out': check_out}])
             
+            attendance_cache.record(self.url, self.db, employee_id,
+                                    {'id': attendance_id, 'check_out': check_out})
             logger.info(f"Asistencia cerrada exitosamente. ID: {attendance_id}")
             return True
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error cerrando asistencia: {e}")
             return False
     
+    @_instrumented
     def get_open_attendance(self, employee_id):
         """Obtener asistencia abierta del empleado"""
         try:
@@ -135,9 +249,11 @@ class OdooAPI:
                 return None
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error obteniendo asistencia abierta: {e}")
             return None
 
+    @_instrumented
     def get_last_attendance(self, employee_id):
         """Obtener la última asistencia del empleado (abierta o cerrada)"""
         try:
@@ -154,5 +270,126 @@ class OdooAPI:
                 return None
                 
         except Exception as e:
+            self._handle_error(e)
             logger.error(f"Error obteniendo última asistencia: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @_instrumented
+    def get_recent_attendances(self, employee_id, limit=STATUS_LIMIT):
+        """Las últimas `limit` asistencias del empleado, de la más reciente a la más antigua
+
+        Lanza la excepción si falla la llamada.
+        """
+        try:
+            return self.models.execute_kw(self.db, self.uid, self.password,
+                                        'hr.attendance', 'search_read',
+                                        [[['employee_id', '=', employee_id]]],
+                                        {'fields': ['id', 'check_in', 'check_out'],
+                                         'order': 'check_in desc, id desc',
+                                         'limit': limit})
+        except Exception as e:
+            self._handle_error(e)
+            logger.error(f"Error obteniendo asistencias recientes: {e}")
+            raise
+
+    def get_attendance_status(self, employee_id, limit=STATUS_LIMIT):
+        """Asistencia abierta, última cerrada y horas de hoy con un solo search_read
+
+        Las asistencias más recientes se ordenan y limitan en el servidor. Devuelve el
+        resumen de attendance_cache.summarize más los registros en 'records', o None si falla.
+        """
+        try:
+            records = self.get_recent_attendances(employee_id, limit)
+        except Exception:
+            return None
+
+        summary = attendance_cache.summarize(records)
+        summary['records'] = records
+        return summary
+
+    @_instrumented
+    def get_time_off(self, start, end):
+        """Festivos y ausencias aprobadas de toda la base de datos que se solapan con [start, end)
+
+        start y end son cadenas 'YYYY-MM-DD HH:MM:SS' en UTC. Devuelve un dict con los
+        festivos ('holidays': (calendar_id o None = todos, desde, hasta)) y las ausencias
+        ('leaves': (employee_id, desde, hasta, día completo)). Las consultas son para todos
+        los empleados a la vez, no por usuario. Lanza la excepción si falla una llamada.
+        """
+        overlap = [['date_from', '<', end], ['date_to', '>', start]]
+        try:
+            # Festivos globales: sin recurso asociado; calendar_id vacío = todos los calendarios
+            holidays = self.models.execute_kw(self.db, self.uid, self.password,
+                                            'resource.calendar.leaves', 'search_read',
+                                            [[['resource_id', '=', False]] + overlap],
+                                            {'fields': ['calendar_id', 'date_from', 'date_to']})
+            leaves = self.models.execute_kw(self.db, self.uid, self.password,
+                                          'hr.leave', 'search_read',
+                                          [[['state', '=', 'validate']] + overlap],
+                                          {'fields': ['employee_id', 'date_from', 'date_to',
+                                                      'request_unit_half', 'request_unit_hours']})
+        except Exception as e:
+            self._handle_error(e)
+            logger.error(f"Error obteniendo festivos y ausencias: {e}")
+            raise
+
+        return {
+            'holidays': [(holiday['calendar_id'][0] if holiday.get('calendar_id') else None,
+                          holiday['date_from'], holiday['date_to']) for holiday in holidays],
+            # Medio día o por horas solo cuentan en su franja; el resto cubre el día entero
+            'leaves': [(leave['employee_id'][0], leave['date_from'], leave['date_to'],
+                        not (leave.get('request_unit_half') or leave.get('request_unit_hours')))
+                       for leave in leaves if leave.get('employee_id')]
+        }
+
+    @_instrumented
+    def get_calendar_employees(self, calendar_ids):
+        """Empleados de cada uno de los calendarios indicados: {calendar_id: {employee_id, ...}}
+
+        Lanza la excepción si falla la llamada.
+        """
+        try:
+            employees = self.models.execute_kw(self.db, self.uid, self.password,
+                                             'hr.employee', 'search_read',
+                                             [[['resource_calendar_id', 'in', list(calendar_ids)]]],
+                                             {'fields': ['id', 'resource_calendar_id']})
+        except Exception as e:
+            self._handle_error(e)
+            logger.error(f"Error obteniendo empleados por calendario: {e}")
+            raise
+        by_calendar = {}
+        for employee in employees:
+            if employee.get('resource_calendar_id'):
+                by_calendar.setdefault(employee['resource_calendar_id'][0], set()).add(employee['id'])
+        return by_calendar
+
+    def iter_attendances(self, employee_id, start, end, fields=('check_in', 'check_out'), chunk_size=200):
+        """Recorrer las asistencias con check_in en [start, end) en bloques de chunk_size
+
+        start y end son cadenas 'YYYY-MM-DD HH:MM:SS' en UTC. La paginación es por id
+        (keyset), así que la memoria usada no depende del tamaño del rango. Lanza la
+        excepción si falla una llamada, para no devolver un resultado incompleto.
+        """
+        fields = ['id'] + [field for field in fields if field != 'id']
+        last_id = 0
+        while True:
+            try:
+                attendances = self.models.execute_kw(self.db, self.uid, self.password,
+                                                   'hr.attendance', 'search_read',
+                                                   [[['employee_id', '=', employee_id],
+                                                     ['check_in', '>=', start],
+                                                     ['check_in', '<', end],
+                                                     ['id', '>', last_id]]],
+                                                   {'fields': fields,
+                                                    'order': 'id asc',
+                                                    'limit': chunk_size})
+            except Exception as e:
+                self._handle_error(e)
+                logger.error(f"Error leyendo asistencias: {e}")
+                raise
+
+            yield from attendances
+
+            if len(attendances) < chunk_size:
+                return
+            last_id = attendances[-1]['id']
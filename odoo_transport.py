@@ -0,0 +1,308 @@
+import os
+import gzip
+import json
+import errno
+import logging
+import itertools
+import threading
+import http.client
+import xmlrpc.client
+from urllib.parse import urlparse
+import circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+# Configuración del transporte HTTP hacia Odoo
+CONNECT_TIMEOUT = float(os.environ.get('ODOO_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.environ.get('ODOO_READ_TIMEOUT', 30))
+POOL_SIZE = int(os.environ.get('ODOO_POOL_SIZE', 8))
+# Timeouts por host, p. ej. {"odoo.lento.com": {"connect": 5, "read": 60}}
+HOST_TIMEOUTS = json.loads(os.environ.get('ODOO_HOST_TIMEOUTS') or '{}')
+# Tamaño mínimo (bytes) a partir del cual se comprime el cuerpo con gzip. Vacío = sin comprimir
+GZIP_THRESHOLD = int(os.environ['ODOO_GZIP_THRESHOLD']) if os.environ.get('ODOO_GZIP_THRESHOLD') else None
+
+# Errores que indican que una conexión reutilizada ya estaba cerrada por el servidor
+_STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+def _is_stale_connection_error(error):
+    if isinstance(error, (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                          http.client.BadStatusLine)):
+        return True
+    return isinstance(error, OSError) and error.errno in _STALE_ERRNOS
+
+class ConnectionPool:
+    """Pool de conexiones HTTP persistentes hacia un host de Odoo"""
+
+    def __init__(self, scheme, host, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_size=POOL_SIZE):
+        self.scheme = scheme
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        # Protocolo de la última petición: la prueba del circuito usa el mismo endpoint
+        self.protocol = 'xmlrpc'
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            connection = http.client.HTTPSConnection(self.host, timeout=self.connect_timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, timeout=self.connect_timeout)
+        connection.connect()
+        # Una vez conectados, el resto de operaciones usa el timeout de lectura
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def acquire(self, fresh=False):
+        """Obtener una conexión libre del pool o abrir una nueva"""
+        if not fresh:
+            with self._lock:
+                while self._idle:
+                    connection = self._idle.pop()
+                    if connection.sock is not None:
+                        return connection
+                    connection.close()
+        return self._new_connection()
+
+    def release(self, connection):
+        """Devolver una conexión sana al pool"""
+        with self._lock:
+            if connection.sock is not None and len(self._idle) < self.max_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def discard(self, connection):
+        """Cerrar una conexión que quedó en un estado inválido"""
+        connection.close()
+
+    def clear(self):
+        """Cerrar todas las conexiones inactivas"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def probe(self):
+        """Comprobar con una conexión nueva que el host responde (common.version)
+
+        Usa el protocolo con el que se está usando el host, porque un proxy puede exponer
+        solo /jsonrpc o solo /xmlrpc. Cualquier respuesta que no sea 5xx indica que está vivo.
+        """
+        connection = self._new_connection()
+        try:
+            if self.protocol == 'jsonrpc':
+                body = json.dumps({'jsonrpc': '2.0', 'method': 'call', 'id': 0,
+                                   'params': {'service': 'common', 'method': 'version', 'args': []}}).encode('utf-8')
+                connection.request('POST', '/jsonrpc', body=body, headers={'Content-Type': 'application/json'})
+            else:
+                body = xmlrpc.client.dumps((), 'version').encode('utf-8')
+                connection.request('POST', '/xmlrpc/2/common', body=body, headers={'Content-Type': 'text/xml'})
+            response = connection.getresponse()
+            response.read()
+            return response.status < 500
+        finally:
+            connection.close()
+
+def _request_with_retry(pool, send, protocol='xmlrpc'):
+    """Ejecutar send(fresh); reintentar una vez con conexión nueva si la reutilizada estaba cerrada
+
+    Pasa por el circuito del host: falla al instante si está abierto y cuenta los
+    errores de red. Un Fault es una respuesta de Odoo, así que el host está sano.
+    """
+    pool.protocol = protocol
+    breaker = circuit_breaker.get_breaker(pool.host, pool.probe)
+    breaker.before_call()
+    for attempt in (0, 1):
+        try:
+            result = send(bool(attempt))
+        except xmlrpc.client.Fault:
+            breaker.record_success()
+            raise
+        except xmlrpc.client.ProtocolError as e:
+            # Solo los errores 5xx indican que el servidor está caído
+            if e.errcode >= 500:
+                breaker.record_failure(e)
+            else:
+                breaker.record_success()
+            raise
+        except Exception as e:
+            if attempt or not _is_stale_connection_error(e):
+                breaker.record_failure(e)
+                raise
+            pool.clear()
+            continue
+        breaker.record_success()
+        return result
+
+class PooledTransport(xmlrpc.client.Transport):
+    """Transporte XML-RPC que reutiliza conexiones keep-alive de un pool compartido"""
+
+    def __init__(self, pool, gzip_threshold=GZIP_THRESHOLD):
+        super().__init__()
+        self.pool = pool
+        self.encode_threshold = gzip_threshold
+
+    def request(self, host, handler, request_body, verbose=False):
+        return _request_with_retry(
+            self.pool, lambda fresh: self._pooled_request(handler, request_body, verbose, fresh=fresh)
+        )
+
+    def _pooled_request(self, handler, request_body, verbose, fresh=False):
+        connection = self.pool.acquire(fresh=fresh)
+        try:
+            headers = self._headers + self._extra_headers
+            if verbose:
+                connection.set_debuglevel(1)
+            if self.accept_gzip_encoding:
+                connection.putrequest("POST", handler, skip_accept_encoding=True)
+                headers.append(("Accept-Encoding", "gzip"))
+            else:
+                connection.putrequest("POST", handler)
+            headers.append(("Content-Type", "text/xml"))
+            headers.append(("User-Agent", self.user_agent))
+            self.send_headers(connection, headers)
+            self.send_content(connection, request_body)
+
+            response = connection.getresponse()
+            if response.status == 200:
+                self.verbose = verbose
+                try:
+                    result = self.parse_response(response)
+                except xmlrpc.client.Fault:
+                    # La respuesta se leyó completa, la conexión sigue siendo válida
+                    self.pool.release(connection)
+                    raise
+                self.pool.release(connection)
+                return result
+        except xmlrpc.client.Fault:
+            raise
+        except Exception:
+            self.pool.discard(connection)
+            raise
+
+        # Respuesta de error: descartar el cuerpo y la conexión
+        response.read()
+        self.pool.discard(connection)
+        raise xmlrpc.client.ProtocolError(
+            self.pool.host + handler,
+            response.status, response.reason,
+            dict(response.getheaders())
+        )
+
+class JsonRpcTransport:
+    """Transporte JSON-RPC (/jsonrpc) sobre el mismo pool de conexiones persistentes"""
+
+    user_agent = 'odoo-attendance-bot/jsonrpc'
+
+    def __init__(self, pool, gzip_threshold=GZIP_THRESHOLD):
+        self.pool = pool
+        self.encode_threshold = gzip_threshold
+        self._ids = itertools.count(1)
+
+    def call(self, service, method, *args):
+        payload = {
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': service, 'method': method, 'args': list(args)},
+            'id': next(self._ids)
+        }
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        response = _request_with_retry(self.pool, lambda fresh: self._pooled_request('/jsonrpc', body, fresh),
+                                       protocol='jsonrpc')
+
+        error = response.get('error')
+        if error:
+            data = error.get('data') or {}
+            # Se usa Fault para que los errores remotos se traten igual que con XML-RPC
+            raise xmlrpc.client.Fault(
+                error.get('code', 0),
+                f"{data.get('name', '')}: {data.get('message') or error.get('message', '')}"
+            )
+        return response.get('result')
+
+    def _pooled_request(self, handler, body, fresh=False):
+        connection = self.pool.acquire(fresh=fresh)
+        try:
+            headers = {
+                'Content-Type': 'application/json',
+                'Accept-Encoding': 'gzip',
+                'User-Agent': self.user_agent
+            }
+            if self.encode_threshold is not None and self.encode_threshold < len(body):
+                headers['Content-Encoding'] = 'gzip'
+                body = gzip.compress(body)
+            connection.request('POST', handler, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            self.pool.discard(connection)
+            raise
+
+        if response.status != 200:
+            self.pool.discard(connection)
+            raise xmlrpc.client.ProtocolError(
+                self.pool.host + handler,
+                response.status, response.reason,
+                dict(response.getheaders())
+            )
+
+        self.pool.release(connection)
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+class JsonRpcProxy:
+    """Equivalente a xmlrpc.client.ServerProxy para un servicio de /jsonrpc"""
+
+    def __init__(self, transport, service):
+        self._transport = transport
+        self._service = service
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self._transport.call(self._service, method, *args)
+
+_pools = {}
+_transports = {}
+_json_transports = {}
+_registry_lock = threading.Lock()
+
+def get_pool(url):
+    """Pool de conexiones compartido para el host de una URL"""
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    with _registry_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            timeouts = HOST_TIMEOUTS.get(parsed.netloc) or HOST_TIMEOUTS.get(parsed.hostname) or {}
+            pool = ConnectionPool(parsed.scheme, parsed.netloc,
+                                  connect_timeout=float(timeouts.get('connect', CONNECT_TIMEOUT)),
+                                  read_timeout=float(timeouts.get('read', READ_TIMEOUT)))
+            _pools[key] = pool
+        return pool
+
+def get_transport(url):
+    """Transporte XML-RPC compartido para el host de una URL"""
+    pool = get_pool(url)
+    key = (pool.scheme, pool.host)
+    with _registry_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = PooledTransport(pool)
+            _transports[key] = transport
+        return transport
+
+def get_json_transport(url):
+    """Transporte JSON-RPC compartido para el host de una URL"""
+    pool = get_pool(url)
+    key = (pool.scheme, pool.host)
+    with _registry_lock:
+        transport = _json_transports.get(key)
+        if transport is None:
+            transport = JsonRpcTransport(pool)
+            _json_transports[key] = transport
+        return transport
@@ -0,0 +1,157 @@
+import io
+import os
+import re
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Duración máxima de un muestreo y segundos entre muestras
+MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 120))
+SAMPLE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+
+# Hilos de cada parte del bot, por prefijo del nombre
+THREAD_GROUPS = {
+    'bot': ('MainThread', 'poll', 'command', 'telegram-sender', 'persistence'),
+    'scheduler': ('scheduler', 'ThreadPoolExecutor', 'tick', 'scheduled', 'mark-retries', 'catch-up',
+                  'coordination'),
+}
+
+# Solo un perfilado a la vez: el muestreo y cProfile se estorbarían entre sí
+_busy = threading.Lock()
+# Ejecución programada armada para perfilarse: acción -> función que recibe el resultado
+_armed = {}
+# Último perfil de una ejecución programada por acción
+_results = {}
+_armed_lock = threading.Lock()
+
+class ProfilerBusy(Exception):
+    """Ya hay un perfilado en curso"""
+
+def _thread_group(name):
+    """Nombre del hilo sin el número final (command_3 -> command, telegram-sender-0 -> telegram-sender)"""
+    return re.sub(r'([-_]\d+)+$', '', name)
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _collapse(counts):
+    """Formato collapsed-stack (flamegraph.pl, speedscope): 'hilo;raíz;...;hoja muestras'"""
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+def sample(seconds, target='all', interval=SAMPLE_INTERVAL):
+    """Muestrear las pilas de los hilos de `target` ('bot', 'scheduler' o 'all') durante `seconds`
+
+    Devuelve el perfil en formato collapsed-stack. Lanza ProfilerBusy si ya hay otro perfilado.
+    """
+    if target != 'all' and target not in THREAD_GROUPS:
+        raise ValueError(f"Objetivo de perfilado desconocido: {target}")
+    prefixes = None if target == 'all' else THREAD_GROUPS[target]
+    seconds = min(max(seconds, interval), MAX_SECONDS)
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("Ya hay un perfilado en curso")
+    try:
+        me = threading.get_ident()
+        counts = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if ident == me or name is None:
+                    continue
+                group = _thread_group(name)
+                if prefixes is not None and not group.startswith(prefixes):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(group)
+                counts[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _busy.release()
+    logger.info(f"Perfilado de '{target}' terminado: {samples} muestras en {seconds:.0f}s")
+    return _collapse(counts)
+
+def profile_call(func, *args, threads=THREAD_GROUPS['scheduler'], **kwargs):
+    """Ejecutar func con cProfile en el hilo actual y en los hilos que cree mientras se ejecuta
+
+    Devuelve (resultado, estadísticas en formato pstats). Los hilos con nombre en `threads`
+    creados durante la llamada (los workers de las marcas) se perfilan cada uno con su
+    propio cProfile y se suman al final. Lanza ProfilerBusy si ya hay otro perfilado.
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("Ya hay un perfilado en curso")
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def start_thread_profiler(frame, event, arg):
+        # Primer evento de un hilo nuevo: cambiar este hook por un cProfile propio del hilo
+        sys.setprofile(None)
+        if not _thread_group(threading.current_thread().name).startswith(threads):
+            return
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    try:
+        threading.setprofile(start_thread_profiler)
+        profilers[0].enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profilers[0].disable()
+            threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profilers)
+    finally:
+        _busy.release()
+    return result, stats
+
+def dump_stats(stats):
+    """Contenido de un archivo .pstats (el que escribe pstats.Stats.dump_stats)"""
+    return marshal.dumps(stats.stats)
+
+def summarize_stats(stats, limit=15):
+    """Las funciones con más tiempo acumulado, como texto"""
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
+
+def arm(action, deliver=None):
+    """Perfilar la próxima ejecución programada de `action`
+
+    El resultado se guarda para last_result(); además se pasa a `deliver(summary, stats)` si se indica.
+    """
+    def handle(summary, stats):
+        with _armed_lock:
+            _results[action] = {'summary': summary, 'pstats': dump_stats(stats),
+                                'text': summarize_stats(stats), 'finished': time.time()}
+        if deliver:
+            deliver(summary, stats)
+
+    with _armed_lock:
+        _armed[action] = handle
+
+def last_result(action):
+    """Último perfil guardado de una ejecución programada de `action` (None si no hay)"""
+    with _armed_lock:
+        return _results.get(action)
+
+def take_armed(action):
+    """Función de entrega si la próxima ejecución de `action` debe perfilarse (se desarma)"""
+    with _armed_lock:
+        return _armed.pop(action, None)
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+import pytz
+
+CUBA_TZ = pytz.timezone('America/Havana')
+ODOO_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Por encima de estos días el informe muestra solo el resumen semanal
+MAX_DAILY_ROWS = 62
+# Rango máximo permitido para /report <desde> <hasta>
+MAX_RANGE_DAYS = 366
+
+def parse_period(args, now=None):
+    """Interpretar los argumentos de /report
+
+    Devuelve (inicio, fin, título) con fechas locales de Cuba, o None si los
+    argumentos no son válidos. Acepta 'week', 'month' o 'AAAA-MM-DD AAAA-MM-DD'.
+    """
+    now = now or datetime.now(CUBA_TZ)
+    today = CUBA_TZ.localize(datetime(now.year, now.month, now.day))
+
+    if not args or args[0] in ('week', 'semana'):
+        start = today - timedelta(days=today.weekday())
+        return start, now, "Semana actual"
+
+    if args[0] in ('month', 'mes'):
+        start = CUBA_TZ.localize(datetime(now.year, now.month, 1))
+        return start, now, "Mes actual"
+
+    if len(args) == 2:
+        try:
+            start = CUBA_TZ.localize(datetime.strptime(args[0], '%Y-%m-%d'))
+            end = CUBA_TZ.localize(datetime.strptime(args[1], '%Y-%m-%d')) + timedelta(days=1)
+        except ValueError:
+            return None
+        if end <= start or (end - start).days > MAX_RANGE_DAYS:
+            return None
+        return start, min(end, now), f"{args[0]} a {args[1]}"
+
+    return None
+
+def to_odoo_utc(value):
+    """Fecha local a cadena UTC en el formato de Odoo"""
+    return value.astimezone(pytz.utc).strftime(ODOO_DATETIME_FORMAT)
+
+def _parse_odoo(value):
+    return pytz.utc.localize(datetime.strptime(value, ODOO_DATETIME_FORMAT)).astimezone(CUBA_TZ)
+
+def aggregate_hours(attendances, now=None):
+    """Sumar horas trabajadas por día y por semana en una sola pasada
+
+    Las asistencias abiertas cuentan hasta `now`. Cada asistencia se asigna al día
+    de su entrada. Devuelve (horas_por_día, horas_por_semana, total).
+    """
+    now = now or datetime.now(CUBA_TZ)
+    daily = {}
+    weekly = {}
+    total = 0.0
+
+    for attendance in attendances:
+        check_in = _parse_odoo(attendance['check_in'])
+        check_out = _parse_odoo(attendance['check_out']) if attendance.get('check_out') else now
+        hours = max(0.0, (check_out - check_in).total_seconds() / 3600)
+
+        day = check_in.date()
+        week = day - timedelta(days=day.weekday())
+        daily[day] = daily.get(day, 0.0) + hours
+        weekly[week] = weekly.get(week, 0.0) + hours
+        total += hours
+
+    return daily, weekly, total
+
+def format_hours(hours):
+    """Horas decimales a '7h 05m'"""
+    minutes = int(round(hours * 60))
+    return f"{minutes // 60}h {minutes % 60:02d}m"
+
+def format_report(title, daily, weekly, total):
+    """Tabla de texto compacta con las horas por día y por semana"""
+    lines = [f"📊 Horas trabajadas - {title}", ""]
+
+    if not daily:
+        lines.append("No hay asistencias registradas en este periodo.")
+        return "\n".join(lines)
+
+    table = []
+    if len(daily) <= MAX_DAILY_ROWS:
+        table.append("Día          Horas")
+        for day in sorted(daily):
+            table.append(f"{day.strftime('%a %d/%m')}  {format_hours(daily[day]):>8}")
+        table.append("")
+
+    table.append("Semana       Horas")
+    for week in sorted(weekly):
+        table.append(f"{week.strftime('%d/%m/%Y')}  {format_hours(weekly[week]):>8}")
+
+    lines.append("<pre>" + "\n".join(table) + "</pre>")
+    lines.append(f"⏱️ Total: {format_hours(total)}")
+    return "\n".join(lines)
@@ -1,51 +1,452 @@
+import os
+import time
+import heapq
+import hashlib
 import logging
-from handlers import user_configs
+import threading
+from itertools import zip_longest
+from urllib.parse import urlparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pytz
+import metrics
+import storage
+import mark_queue
+import schedules
+import coordination
+import calendar_cache
+import profiler
+from rate_limit import TokenBucket
 from odoo_api import OdooAPI
 
 logger = logging.getLogger(__name__)
 
-def scheduled_check_in():
-    """Tarea programada para marcar entrada (8:00 AM)"""
-    logger.info("Ejecutando marcado automático de entrada...")
-    
-    for user_id, config in user_configs.items():
+# Límites de concurrencia para las tareas programadas
+MAX_WORKERS = int(os.environ.get('SCHEDULER_MAX_WORKERS', 16))
+MAX_PER_HOST = int(os.environ.get('SCHEDULER_MAX_PER_HOST', 4))
+# Ventana (segundos) en la que se reparten las marcas de cada ejecución. 0 = todas a la vez
+WINDOW = float(os.environ.get('SCHEDULER_WINDOW', 60))
+# Marcas por segundo que se lanzan como máximo contra un mismo host
+HOST_RATE = float(os.environ.get('SCHEDULER_HOST_RATE', 5))
+# Parte final de la ventana reservada para que terminen las últimas marcas
+WINDOW_MARGIN = 0.2
+# Margen para recuperar los minutos que no se procesaron mientras el bot estaba caído
+MISFIRE_GRACE = int(os.environ.get('SCHEDULER_MISFIRE_GRACE', 3600))
+RETRY_POLL_INTERVAL = 5
+# Resultado de _mark_user cuando el empleado tiene festivo o ausencia ese día
+SKIPPED = 'skipped'
+
+CUBA_TZ = pytz.timezone('America/Havana')
+
+# Configuraciones leídas del almacén compartido y su versión (ver _load_configs)
+_configs = {}
+_configs_version = None
+_configs_lock = threading.Lock()
+
+# Marcas en curso en todo el proceso: varias ejecuciones simultáneas (minutos atrasados,
+# reintentos) comparten el límite de MAX_WORKERS aunque cada una tenga su propio pool
+_mark_slots = threading.BoundedSemaphore(MAX_WORKERS)
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def _load_configs():
+    """Configuraciones de todos los usuarios según el almacén compartido (PERSISTENCE_DB)
+
+    Cada instancia carga user_configs solo al arrancar, así que no ve a los usuarios que
+    se configuran en otra ni sus cambios de /schedule. Se releen del almacén, junto con
+    el índice de horarios, cada vez que cambia su versión.
+    """
+    global _configs, _configs_version
+    with _configs_lock:
+        store = storage.get_store()
+        version = store.configs_version()
+        if version != _configs_version:
+            _configs = store.load_configs()
+            _configs_version = version
+            schedules.index.rebuild(_configs)
+        return _configs
+
+def _host_of(url):
+    """Obtener el host de una URL de Odoo"""
+    return urlparse(url).netloc or url
+
+def _host_semaphore(host):
+    """Semáforo compartido que limita las peticiones simultáneas a un host"""
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(MAX_PER_HOST)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+def _interleave_by_host(items):
+    """Ordenar los usuarios alternando hosts para que ninguno acapare la cola"""
+    by_host = {}
+    for user_id, config in items:
+        by_host.setdefault(_host_of(config.get('url', '')), []).append((user_id, config))
+    ordered = []
+    for group in zip_longest(*by_host.values()):
+        ordered.extend(item for item in group if item is not None)
+    return ordered
+
+def _user_offset(user_id, job, spread):
+    """Desfase determinista del usuario dentro de la ventana (mismo valor en cada ejecución)"""
+    if spread <= 0:
+        return 0.0
+    digest = hashlib.sha1(f'{job}:{user_id}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 * spread
+
+def _host_buckets(users, spread):
+    """Un token bucket por host, con ritmo suficiente para terminar dentro de la ventana"""
+    counts = {}
+    for _, config in users:
+        host = _host_of(config['url'])
+        counts[host] = counts.get(host, 0) + 1
+    buckets = {}
+    for host, count in counts.items():
+        rate = HOST_RATE
+        if spread > 0:
+            rate = max(rate, count / spread)
+        buckets[host] = TokenBucket(rate, capacity=max(1.0, rate))
+    return buckets
+
+def _dispatch_staggered(executor, users, submit, job, window):
+    """Lanzar cada usuario en su momento de la ventana respetando el ritmo de su host"""
+    spread = window * (1 - WINDOW_MARGIN)
+    buckets = _host_buckets(users, spread) if window > 0 else {}
+    start = time.monotonic()
+    pending = []
+    for sequence, (user_id, config) in enumerate(users):
+        due = start + _user_offset(user_id, job, spread)
+        heapq.heappush(pending, (due, sequence, user_id, config))
+
+    futures = {}
+    while pending:
+        due, sequence, user_id, config = pending[0]
+        now = time.monotonic()
+        if due > now:
+            time.sleep(due - now)
+            continue
+        heapq.heappop(pending)
+        bucket = buckets.get(_host_of(config['url']))
+        wait = bucket.try_acquire() if bucket else 0
+        if wait:
+            heapq.heappush(pending, (now + wait, sequence, user_id, config))
+            continue
+        futures[submit(user_id, config)] = user_id
+    return futures
+
+def _mark_user(user_id, config, mark, label, at=None):
+    """Marcar entrada o salida para un usuario. Devuelve True si se marcó
+
+    Con `at`, devuelve SKIPPED sin marcar si el empleado no trabaja en ese instante
+    (ausencia de día completo, o festivo o ausencia parcial que lo cubre), y False si
+    no se pudo consultar para que la marca se reintente.
+    """
+    with _mark_slots, _host_semaphore(_host_of(config['url'])):
+        odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
+
+        if not odoo.authenticate():
+            logger.error(f"Error de autenticación para usuario {user_id}")
+            return False
+
+        employee_id = odoo.get_employee_id()
+        if not employee_id:
+            logger.error(f"No se encontró empleado para usuario {user_id}")
+            return False
+
         try:
-            odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
-            
-            if odoo.authenticate():
-                employee_id = odoo.get_employee_id()
-                if employee_id:
-                    if odoo.create_attendance(employee_id):
-                        logger.info(f"Entrada marcada para usuario {user_id}")
+            off = at and calendar_cache.is_off(odoo, employee_id, at)
+        except calendar_cache.TimeOffUnavailable as e:
+            # Sin saber si está de ausencia no se marca: la marca queda fallida y se reintenta
+            logger.error(f"Sin festivos y ausencias para usuario {user_id}, se reintentará la {label}: {e}")
+            return False
+        if off:
+            logger.info(f"Usuario {user_id} con festivo o ausencia a las {at:%Y-%m-%d %H:%M}: no se marca {label}")
+            return SKIPPED
+
+        if mark(odoo, employee_id):
+            logger.info(f"{label.capitalize()} marcada para usuario {user_id}")
+            return True
+
+        logger.error(f"Error marcando {label} para usuario {user_id}")
+        return False
+
+def _has_open_attendance(odoo, employee_id):
+    """Consultar en Odoo si la última asistencia está abierta (lanza la excepción si falla)"""
+    last = odoo.get_recent_attendances(employee_id, limit=1)
+    return bool(last) and not last[0].get('check_out')
+
+def _check_in(odoo, employee_id, retry=False):
+    # En un reintento la entrada pudo haberse creado antes del fallo: no duplicarla
+    if retry and _has_open_attendance(odoo, employee_id):
+        return True
+    return odoo.create_attendance(employee_id)
+
+def _check_out(odoo, employee_id, retry=False):
+    # En un reintento sin asistencia abierta no queda nada por cerrar
+    if retry and not _has_open_attendance(odoo, employee_id):
+        return True
+    return odoo.close_attendance(employee_id)
+
+ACTIONS = {
+    'check_in': {'label': 'entrada', 'mark': _check_in},
+    'check_out': {'label': 'salida', 'mark': _check_out}
+}
+
+def _run_marks(action, users, run_key, window, attempts=None):
+    """Ejecutar las marcas de `users` en paralelo y registrar el resultado en la cola de reintentos
+
+    attempts indica los intentos previos por usuario (reintentos); None es una ejecución nueva.
+    """
+    label = ACTIONS[action]['label']
+    retry = attempts is not None
+    mark = lambda odoo, employee_id: ACTIONS[action]['mark'](odoo, employee_id, retry=retry)
+    run_minute = _run_minute(run_key)
+    successes = 0
+    failures = 0
+    skipped = 0
+
+    if users:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='scheduled') as executor:
+            futures = _dispatch_staggered(
+                executor, _interleave_by_host(users),
+                lambda user_id, config: executor.submit(_mark_user, user_id, config, mark, label,
+                                                        _mark_time(action, config, run_minute)),
+                action, window
+            )
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logger.error(f"Error en {label} automática para usuario {user_id}: {e}")
+                    ok = False
+                result = 'skipped' if ok == SKIPPED else 'success' if ok else 'failure'
+                metrics.SCHEDULED_MARKS.inc(action=action, result=result)
+                metrics.SCHEDULED_USER_MARKS.inc(action=action, user_id=user_id, result=result)
+                try:
+                    if ok == SKIPPED:
+                        skipped += 1
+                        mark_queue.complete(run_key, user_id)
+                    elif ok:
+                        successes += 1
+                        mark_queue.complete(run_key, user_id)
                     else:
-                        logger.error(f"Error marcando entrada para usuario {user_id}")
-                else:
-                    logger.error(f"No se encontró empleado para usuario {user_id}")
-            else:
-                logger.error(f"Error de autenticación para usuario {user_id}")
-                
+                        failures += 1
+                        previous = attempts.get(user_id, 0) if retry else 0
+                        mark_queue.fail(run_key, user_id, previous + 1, f"{label} fallida")
+                except Exception as e:
+                    logger.error(f"Error actualizando la cola de reintentos: {e}")
+
+    return successes, failures, skipped
+
+def _run_for_all_users(action, run_key, window=None, users=None):
+    """Ejecutar una marca en paralelo para los usuarios indicados (todos si es None) y resumir el resultado
+
+    Las marcas se reparten en la ventana con un desfase determinista por usuario,
+    para no lanzar todas las peticiones a Odoo en el mismo segundo. `users` ya están
+    reservados en la cola persistente (ver _claim); con None se guardan y reservan aquí.
+    Así las fallidas o interrumpidas se reintentan.
+    """
+    window = WINDOW if window is None else window
+    label = ACTIONS[action]['label']
+    start = time.monotonic()
+    if users is None:
+        users = [(user_id, config) for user_id, config in _load_configs().items() if 'url' in config]
+        try:
+            users = _claim(action, run_key, users)
+        except Exception as e:
+            logger.error(f"Error guardando las marcas pendientes de {run_key}: {e}")
+
+    deliver_profile = profiler.take_armed(action)
+    stats = None
+    if deliver_profile:
+        try:
+            (successes, failures, skipped), stats = profiler.profile_call(_run_marks, action, users, run_key, window)
+        except profiler.ProfilerBusy:
+            logger.warning(f"No se perfila {run_key}: ya hay otro perfilado en curso")
+            successes, failures, skipped = _run_marks(action, users, run_key, window)
+    else:
+        successes, failures, skipped = _run_marks(action, users, run_key, window)
+
+    summary = {
+        'users': len(users),
+        'successes': successes,
+        'failures': failures,
+        'skipped': skipped,
+        'elapsed': time.monotonic() - start
+    }
+    metrics.SCHEDULER_JOB_DURATION.observe(summary['elapsed'], job=action)
+    if window and summary['elapsed'] > window:
+        logger.warning(f"La {label} automática terminó {summary['elapsed'] - window:.1f}s después de la ventana")
+    logger.info(
+        f"Resumen de {label} automática ({run_key}): {summary['users']} usuarios, "
+        f"{successes} exitosos, {failures} fallidos, {skipped} sin marcar por festivo o ausencia, "
+        f"{summary['elapsed']:.2f}s"
+    )
+    if stats is not None:
+        try:
+            deliver_profile(summary, stats)
         except Exception as e:
-            logger.error(f"Error en entrada automática para usuario {user_id}: {e}")
+            logger.error(f"Error entregando el perfil de {run_key}: {e}")
+    return summary
+
+def _run_key(action, minute):
+    return f"{action}:{minute.strftime('%Y-%m-%dT%H:%M')}"
+
+def _run_minute(run_key):
+    """Minuto (hora de Cuba) de una ejecución a partir de su clave"""
+    try:
+        return CUBA_TZ.localize(datetime.strptime(run_key.split(':', 1)[1], '%Y-%m-%dT%H:%M'))
+    except (IndexError, ValueError):
+        return None
+
+def _mark_time(action, config, run_minute):
+    """Instante con el que se comprueban festivos y ausencias antes de marcar
+
+    La salida usa la hora de entrada de ese día: así se omite exactamente cuando se omitió
+    la entrada y no queda una salida sin entrada ni una entrada sin cerrar.
+    """
+    if run_minute is None or action != 'check_out':
+        return run_minute
+    check_in = schedules.check_in_time(config, run_minute.weekday())
+    if check_in is None:
+        return run_minute
+    hour, minute = map(int, check_in.split(':'))
+    return CUBA_TZ.localize(datetime.combine(run_minute.date(), datetime.min.time()).replace(hour=hour, minute=minute))
+
+def scheduled_check_in():
+    """Marcar entrada ahora para todos los usuarios configurados"""
+    logger.info("Ejecutando marcado automático de entrada...")
+    return _run_for_all_users('check_in', _run_key('check_in', datetime.now(CUBA_TZ)))
 
 def scheduled_check_out():
-    """Tarea programada para marcar salida"""
+    """Marcar salida ahora para todos los usuarios configurados"""
     logger.info("Ejecutando marcado automático de salida...")
-    
-    for user_id, config in user_configs.items():
+    return _run_for_all_users('check_out', _run_key('check_out', datetime.now(CUBA_TZ)))
+
+_tick_lock = threading.Lock()
+
+def _minutes_to_process(now, grace):
+    """Minutos pendientes desde el último tick procesado, como mucho `grace` segundos atrás"""
+    minute = now.astimezone(pytz.utc).replace(second=0, microsecond=0)
+    with _tick_lock:
+        store = storage.get_store()
+        last_tick = store.get_meta('last_tick')
+        first = minute
+        if last_tick:
+            first = max(datetime.fromisoformat(last_tick).astimezone(pytz.utc) + timedelta(minutes=1),
+                        minute - timedelta(seconds=grace))
+        if first > minute:
+            return []
+        store.set_meta('last_tick', minute.isoformat())
+    count = int((minute - first).total_seconds() // 60) + 1
+    return [(first + timedelta(minutes=i)).astimezone(CUBA_TZ) for i in range(count)]
+
+def _claim(action, run_key, users, owns=None):
+    """Guardar en la cola las marcas de `users` y reservar las que ejecuta esta instancia
+
+    Con SCHEDULER_SHARDING `owns` indica la parte de esta instancia; las filas del resto
+    quedan libres en la cola y cada instancia viva reserva las suyas desde
+    process_due_retries. Si una instancia cayó y las demás aún no lo saben, sus marcas
+    siguen en la cola y las reserva su nuevo dueño cuando se actualizan las instancias activas.
+    """
+    mark_queue.enqueue(run_key, action, [user_id for user_id, _ in users])
+    mine = [user_id for user_id, _ in users if owns is None or owns(user_id)]
+    claimed = set(mark_queue.claim(run_key, mine))
+    return [(user_id, config) for user_id, config in users if user_id in claimed]
+
+def run_tick(now=None, grace=MISFIRE_GRACE):
+    """Tick de cada minuto: marcar a los usuarios cuyo horario cae en este minuto
+
+    También procesa los minutos que no se ejecutaron (bot caído o tick retrasado)
+    dentro del margen de gracia; esas marcas atrasadas se lanzan sin ventana.
+    Solo lo ejecuta el líder. Con SCHEDULER_SHARDING el líder guarda en la cola las
+    marcas de todos los usuarios y ejecuta solo su parte; el resto lo reservan las
+    demás instancias (ver _claim).
+    """
+    coordinator = coordination.get_coordinator()
+    if not coordinator.is_leader():
+        return []
+
+    now = now or datetime.now(CUBA_TZ)
+    configs = _load_configs()
+    groups = []
+    for minute in _minutes_to_process(now, grace):
+        late = now - minute >= timedelta(minutes=1)
+        for action, user_ids in schedules.index.due(minute.weekday(), minute.strftime('%H:%M')).items():
+            users = [(user_id, configs[user_id]) for user_id in user_ids if user_id in configs]
+            if not users:
+                continue
+            run_key = _run_key(action, minute)
+            window = 0 if late else None
+            if late:
+                logger.warning(f"Recuperando {len(users)} marcas de {run_key}")
+            try:
+                users = _claim(action, run_key, users, coordinator.owns if coordinator.sharding else None)
+            except Exception as e:
+                logger.error(f"Error guardando las marcas pendientes de {run_key}: {e}")
+                # Sin cola no se puede repartir; el líder único marca igualmente
+                if coordinator.sharding:
+                    continue
+            if not users:
+                continue
+            groups.append((action, run_key, window, users))
+
+    if not groups:
+        return []
+    # Entradas y salidas del mismo minuto en paralelo; el semáforo por host limita la carga en Odoo
+    with ThreadPoolExecutor(max_workers=min(len(groups), 4), thread_name_prefix='tick') as executor:
+        futures = [executor.submit(_run_for_all_users, action, run_key, window, users)
+                   for action, run_key, window, users in groups]
+        return [future.result() for future in futures]
+
+def process_due_retries(owns=None):
+    """Ejecutar las marcas pendientes vencidas (reintentos y, con sharding, la parte de esta instancia)
+
+    `owns(user_id)` limita las filas a las de esta instancia. Cada fila se reserva antes
+    de ejecutarla, así que ninguna marca la ejecutan dos instancias a la vez.
+    """
+    rows = mark_queue.due()
+    if not rows:
+        return 0
+
+    configs = _load_configs()
+    groups = {}
+    for run_key, user_id, action, attempts in rows:
+        if owns is not None and not owns(user_id):
+            continue
+        config = configs.get(user_id)
+        if not config or 'url' not in config or action not in ACTIONS:
+            # El usuario borró su configuración (según el almacén compartido): no hay nada que reintentar
+            mark_queue.complete(run_key, user_id)
+            continue
+        group = groups.setdefault((run_key, action), {'users': [], 'attempts': {}})
+        group['users'].append((user_id, config))
+        group['attempts'][user_id] = attempts
+
+    processed = 0
+    for (run_key, action), group in groups.items():
+        claimed = set(mark_queue.claim(run_key, group['attempts']))
+        users = [(user_id, config) for user_id, config in group['users'] if user_id in claimed]
+        if not users:
+            continue
+        logger.info(f"Ejecutando {len(users)} marcas pendientes de {run_key}")
+        _run_marks(action, users, run_key, window=0, attempts=group['attempts'])
+        processed += len(users)
+    return processed
+
+def run_retry_worker(interval=RETRY_POLL_INTERVAL):
+    """Bucle que procesa la cola de reintentos (solo en el líder; con sharding, cada instancia su parte)"""
+    coordinator = coordination.get_coordinator()
+    while True:
         try:
-            odoo = OdooAPI(config['url'], config['db'], config['username'], config['password'])
-            
-            if odoo.authenticate():
-                employee_id = odoo.get_employee_id()
-                if employee_id:
-                    if odoo.close_attendance(employee_id):
-                        logger.info(f"Salida marcada para usuario {user_id}")
-                    else:
-                        logger.error(f"Error marcando salida para usuario {user_id}")
-                else:
-                    logger.error(f"No se encontró empleado para usuario {user_id}")
-            else:
-                logger.error(f"Error de autenticación para usuario {user_id}")
-                
+            if coordinator.sharding:
+                process_due_retries(coordinator.owns)
+            elif coordinator.is_leader():
+                process_due_retries()
         except Exception as e:
-            logger.error(f"Error en salida automática para usuario {user_id}: {e}")
+            logger.error(f"Error procesando reintentos: {e}")
+        time.sleep(interval)
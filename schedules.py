@@ -0,0 +1,170 @@
+import html
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DAY_NAMES = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+# Abreviaturas aceptadas en /schedule (español e inglés); 0 = lunes
+DAY_ALIASES = {
+    'lun': 0, 'mar': 1, 'mie': 2, 'mié': 2, 'jue': 3, 'vie': 4, 'sab': 5, 'sáb': 5, 'dom': 6,
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6
+}
+ACTIONS = ('check_in', 'check_out')
+
+# Horario (hora de Cuba) de los usuarios que no han configurado el suyo
+DEFAULT_SCHEDULE = [
+    {'days': [0, 1, 2, 3], 'check_in': '11:58', 'check_out': '21:30'},
+    {'days': [4], 'check_in': '11:58', 'check_out': '20:30'}
+]
+
+# Los mensajes se envían con parse_mode HTML: los < > del texto van escapados
+USAGE = (
+    "Uso: /schedule &lt;entrada&gt; &lt;salida&gt; [días]\n"
+    "Ejemplos:\n"
+    "/schedule 08:00 17:30 lun-vie\n"
+    "/schedule 08:00 17:30 lun-jue; 08:00 16:30 vie\n"
+    "/schedule default - Volver al horario por defecto\n"
+    "/schedule off - Desactivar el marcado automático"
+)
+
+def parse_time(text):
+    """'8:00' o '08:00' a 'HH:MM'; None si no es una hora válida"""
+    hour, sep, minute = text.partition(':')
+    if not sep or not hour.isdigit() or not minute.isdigit() or len(minute) != 2:
+        return None
+    hour, minute = int(hour), int(minute)
+    if hour > 23 or minute > 59:
+        return None
+    return f'{hour:02d}:{minute:02d}'
+
+def parse_days(spec):
+    """'lun-vie' o 'lun,mie,vie' a una lista ordenada de días (0 = lunes)"""
+    days = set()
+    for part in spec.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        if first not in DAY_ALIASES or (last and last not in DAY_ALIASES):
+            raise ValueError(f"Día no reconocido: {html.escape(part.strip())}")
+        start = DAY_ALIASES[first]
+        end = DAY_ALIASES[last] if last else start
+        if end < start:
+            raise ValueError(f"Rango de días inválido: {html.escape(part.strip())}")
+        days.update(range(start, end + 1))
+    return sorted(days)
+
+def parse_schedule(text):
+    """Convertir los argumentos de /schedule en una lista de bloques
+
+    Cada bloque es '<entrada> <salida> [días]' y los bloques se separan con ';'.
+    Lanza ValueError con un mensaje para el usuario si el formato no es válido.
+    """
+    blocks = []
+    used_days = set()
+    for chunk in text.split(';'):
+        parts = chunk.split()
+        if not parts:
+            continue
+        if len(parts) not in (2, 3):
+            raise ValueError(USAGE)
+        check_in, check_out = parse_time(parts[0]), parse_time(parts[1])
+        if not check_in or not check_out:
+            raise ValueError("Las horas deben tener el formato HH:MM (por ejemplo 08:00)")
+        if check_out <= check_in:
+            raise ValueError("La hora de salida debe ser posterior a la de entrada")
+        days = parse_days(parts[2]) if len(parts) == 3 else list(range(5))
+        if used_days.intersection(days):
+            raise ValueError("Un mismo día aparece en más de un bloque")
+        used_days.update(days)
+        blocks.append({'days': days, 'check_in': check_in, 'check_out': check_out})
+    if not blocks:
+        raise ValueError(USAGE)
+    return blocks
+
+def get_schedule(config):
+    """Horario del usuario; el por defecto si no ha configurado uno ([] = desactivado)"""
+    schedule = config.get('schedule') if config else None
+    return DEFAULT_SCHEDULE if schedule is None else schedule
+
+def check_in_time(config, weekday):
+    """Hora de entrada ('HH:MM') del usuario ese día de la semana (None si no marca ese día)"""
+    for block in get_schedule(config):
+        if weekday in block['days']:
+            return block['check_in']
+    return None
+
+def _format_days(days):
+    """[0, 1, 2, 3] -> 'Lunes a Jueves'; [0, 2, 4] -> 'Lunes, Miércoles y Viernes'"""
+    days = sorted(days)
+    if len(days) > 2 and days == list(range(days[0], days[-1] + 1)):
+        return f"{DAY_NAMES[days[0]]} a {DAY_NAMES[days[-1]]}"
+    names = [DAY_NAMES[day] for day in days]
+    return names[0] if len(names) == 1 else f"{', '.join(names[:-1])} y {names[-1]}"
+
+def format_schedule(config):
+    """Líneas de texto con el horario del usuario"""
+    schedule = get_schedule(config)
+    if not schedule:
+        return "⏸️ Marcado automático desactivado"
+    return "\n".join(f"📅 {_format_days(block['days'])}: {block['check_in']} - {block['check_out']}"
+                     for block in schedule)
+
+def _is_complete(config):
+    return bool(config) and all(key in config for key in ('url', 'db', 'username', 'password'))
+
+class ScheduleIndex:
+    """Índice de usuarios por minuto de la semana
+
+    Cada tick del scheduler consulta solo el cubo de su minuto en lugar de recorrer
+    todos los usuarios. Se actualiza por usuario cada vez que cambia su configuración.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (día, 'HH:MM') -> {acción: conjunto de user_id}
+        self._buckets = {}
+        # user_id -> claves de los cubos en los que está
+        self._user_keys = {}
+
+    def _remove(self, user_id):
+        for key, action in self._user_keys.pop(user_id, ()):
+            users = self._buckets[key][action]
+            users.discard(user_id)
+            if not users:
+                del self._buckets[key][action]
+                if not self._buckets[key]:
+                    del self._buckets[key]
+
+    def _add(self, user_id, config):
+        keys = []
+        for block in get_schedule(config):
+            for day in block['days']:
+                for action in ACTIONS:
+                    key = (day, block[action])
+                    self._buckets.setdefault(key, {}).setdefault(action, set()).add(user_id)
+                    keys.append((key, action))
+        if keys:
+            self._user_keys[user_id] = keys
+
+    def update(self, user_id, config):
+        """Reindexar un usuario (se elimina si no tiene una configuración completa)"""
+        with self._lock:
+            self._remove(user_id)
+            if _is_complete(config):
+                self._add(user_id, config)
+
+    def rebuild(self, configs):
+        with self._lock:
+            self._buckets.clear()
+            self._user_keys.clear()
+            for user_id, config in list(configs.items()):
+                if _is_complete(config):
+                    self._add(user_id, config)
+        logger.info(f"Índice de horarios: {len(self._user_keys)} usuarios en {len(self._buckets)} minutos")
+
+    def due(self, weekday, time):
+        """Usuarios que tocan en ese minuto: {acción: [user_id, ...]}"""
+        with self._lock:
+            bucket = self._buckets.get((weekday, time), {})
+            return {action: sorted(users) for action, users in bucket.items()}
+
+index = ScheduleIndex()
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Base de datos SQLite (modo WAL) donde se guardan usuarios, estados y metadatos del bot
+DB_FILE = os.environ.get('PERSISTENCE_DB', 'user_data.sqlite3')
+# Segundos que se espera para agrupar varios cambios seguidos en una sola escritura
+FLUSH_DELAY = float(os.environ.get('PERSISTENCE_FLUSH_DELAY', 0.05))
+
+# Contador en meta que sube con cada escritura de usuarios, para releer solo cuando cambian
+CONFIGS_VERSION_KEY = 'configs_version'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_configs (
+    user_id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scheduled_marks (
+    run_key TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    last_error TEXT,
+    claimed_by TEXT NOT NULL DEFAULT '',
+    claimed_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_key, user_id)
+);
+CREATE INDEX IF NOT EXISTS scheduled_marks_due ON scheduled_marks (next_attempt);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    instance TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending_updates (
+    update_id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    received REAL NOT NULL,
+    claimed_by TEXT NOT NULL DEFAULT '',
+    claimed_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+# Columnas añadidas a tablas existentes: las bases de datos anteriores se actualizan al abrirlas
+ADDED_COLUMNS = [
+    ('scheduled_marks', 'claimed_by', "TEXT NOT NULL DEFAULT ''"),
+    ('scheduled_marks', 'claimed_at', 'REAL NOT NULL DEFAULT 0'),
+    ('pending_updates', 'claimed_by', "TEXT NOT NULL DEFAULT ''"),
+    ('pending_updates', 'claimed_at', 'REAL NOT NULL DEFAULT 0'),
+]
+
+def _user_key(user_id):
+    """Los IDs de Telegram son enteros; el JSON antiguo los guardaba como texto"""
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return user_id
+
+class Store:
+    """Almacén transaccional en SQLite con escrituras por registro"""
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._add_columns()
+
+    def _add_columns(self):
+        for table, column, definition in ADDED_COLUMNS:
+            columns = {row[1] for row in self._conn.execute(f'PRAGMA table_info({table})')}
+            if column in columns:
+                continue
+            try:
+                self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError as e:
+                # Otra instancia la añadió a la vez
+                if 'duplicate column' not in str(e):
+                    raise
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def transaction(self, statements):
+        """Ejecutar una lista de (sql, params) de forma atómica; devuelve las filas de cada una"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                results = [self._conn.execute(sql, params).fetchall() for sql, params in statements]
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return results
+
+    def load(self):
+        """Leer todas las configuraciones y estados"""
+        states = dict(self.execute('SELECT user_id, state FROM user_states'))
+        return self.load_configs(), states
+
+    def load_configs(self):
+        """Leer todas las configuraciones"""
+        return {user_id: json.loads(config)
+                for user_id, config in self.execute('SELECT user_id, config FROM user_configs')}
+
+    def configs_version(self):
+        """Versión de las configuraciones; cambia con cada escritura de cualquier instancia"""
+        return self.get_meta(CONFIGS_VERSION_KEY, 0)
+
+    def is_empty(self):
+        return not (self.execute('SELECT 1 FROM user_configs LIMIT 1')
+                    or self.execute('SELECT 1 FROM user_states LIMIT 1'))
+
+    def write_users(self, configs, states, user_ids):
+        """Escribir (o borrar) solo los registros de los usuarios indicados en una transacción"""
+        statements = []
+        for user_id in user_ids:
+            config = configs.get(user_id)
+            if config is None:
+                statements.append(('DELETE FROM user_configs WHERE user_id = ?', (user_id,)))
+            else:
+                statements.append(('INSERT OR REPLACE INTO user_configs (user_id, config) VALUES (?, ?)',
+                                   (user_id, json.dumps(config))))
+            state = states.get(user_id)
+            if state is None:
+                statements.append(('DELETE FROM user_states WHERE user_id = ?', (user_id,)))
+            else:
+                statements.append(('INSERT OR REPLACE INTO user_states (user_id, state) VALUES (?, ?)',
+                                   (user_id, state)))
+        statements.append(("INSERT INTO meta (key, value) VALUES (?, '1') "
+                           "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                           (CONFIGS_VERSION_KEY,)))
+        self.transaction(statements)
+
+    def get_meta(self, key, default=None):
+        rows = self.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key, value):
+        self.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def migrate_json(self, json_path):
+        """Importar una sola vez el antiguo user_data.json"""
+        if self.get_meta('json_migrated') or not os.path.exists(json_path):
+            return False
+        if not self.is_empty():
+            self.set_meta('json_migrated', True)
+            return False
+
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        configs = {_user_key(k): v for k, v in data.get('user_configs', {}).items()}
+        states = {_user_key(k): v for k, v in data.get('user_states', {}).items()}
+        self.write_users(configs, states, set(configs) | set(states))
+        self.set_meta('json_migrated', True)
+        os.replace(json_path, json_path + '.migrated')
+        logger.info(f"Migrados {len(configs)} usuarios desde {json_path}")
+        return True
+
+class WriteBehind:
+    """Agrupa los usuarios modificados y los escribe en segundo plano en una sola transacción"""
+
+    def __init__(self, store, configs, states, delay=FLUSH_DELAY):
+        self.store = store
+        self.configs = configs
+        self.states = states
+        self.delay = delay
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._event = threading.Event()
+        self._thread = None
+
+    def mark(self, user_ids):
+        with self._lock:
+            self._dirty.update(user_ids)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def flush(self):
+        """Escribir ahora los cambios pendientes"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return
+            try:
+                self.store.write_users(self.configs, self.states, dirty)
+                logger.debug(f"Datos persistentes guardados para {len(dirty)} usuarios")
+            except Exception as e:
+                logger.error(f"Error guardando datos persistentes: {e}")
+                with self._lock:
+                    self._dirty.update(dirty)
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            if self.delay:
+                time.sleep(self.delay)
+            self.flush()
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Almacén compartido del proceso"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = Store()
+        return _store
+
+def flush_all():
+    """Escribir los cambios pendientes de todos los writers (al salir del proceso)"""
+    for writer in _writers:
+        writer.flush()
+
+_writers = []
+atexit.register(flush_all)
+
+def register_writer(writer):
+    _writers.append(writer)
+    return writer
@@ -1,18 +1,252 @@
+import os
 import json
+import time
 import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 import requests
+import metrics
+import tracing
+from rate_limit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
+# Límites de envío de Telegram: ~30 mensajes/s en total y ~1 mensaje/s por chat
+GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+SENDER_THREADS = int(os.environ.get('TELEGRAM_SENDER_THREADS', 4))
+REQUEST_TIMEOUT = float(os.environ.get('TELEGRAM_REQUEST_TIMEOUT', 15))
+POLL_TIMEOUT = 30
+# Segundos que se espera el resultado de un comando antes de mostrar el mensaje "🔄 ..."
+PROGRESS_DELAY = float(os.environ.get('TELEGRAM_PROGRESS_DELAY', 1.0))
+
+def _resolve_message_id(job):
+    """Sustituir el Future del mensaje a editar por su message_id
+
+    El Future ya está resuelto: la cola envía los mensajes de un chat en orden. Si el
+    mensaje original no llegó a enviarse, la edición se envía como un mensaje nuevo.
+    """
+    message_id = job['data'].get('message_id')
+    if not isinstance(message_id, Future):
+        return job
+    result = message_id.result()
+    data = dict(job['data'])
+    if result and result.get('ok'):
+        data['message_id'] = result['result']['message_id']
+        return dict(job, data=data)
+    del data['message_id']
+    return dict(job, method='sendMessage', data=data)
+
+class OutboundQueue:
+    """Cola de envíos hacia Telegram con límites global y por chat y reintentos ante 429"""
+
+    def __init__(self, bot, threads=SENDER_THREADS, global_rate=GLOBAL_RATE,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.bot = bot
+        self.threads = threads
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        # Mensajes pendientes por chat; el orden dentro de cada chat se respeta
+        self._pending = OrderedDict()
+        self._in_flight = set()
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+        self._workers = []
+        self._depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._run, name=f'telegram-sender-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, method, chat_id, data, files=None):
+        """Encolar una llamada a la API y devolver un Future con la respuesta"""
+        future = Future()
+        job = {'method': method, 'chat_id': chat_id, 'data': data, 'files': files,
+               'future': future, 'enqueued': time.monotonic(), 'trace': tracing.current()}
+        with self._condition:
+            self._pending.setdefault(chat_id, deque()).append(job)
+            self._depth += 1
+            self._condition.notify()
+        self.start()
+        return future
+
+    def depth(self):
+        """Número de mensajes pendientes de envío"""
+        with self._condition:
+            return self._depth
+
+    def stats(self):
+        """Contadores de la cola: profundidad, enviados, fallidos y latencia de envío"""
+        with self._condition:
+            sent = self.sent
+            return {
+                'depth': self._depth,
+                'sent': sent,
+                'failed': self.failed,
+                'throttled': self.throttled,
+                'latency_avg': self.latency_total / sent if sent else 0.0,
+                'latency_max': self.latency_max
+            }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        """Elegir el siguiente mensaje enviable. Devuelve (job, espera) con el lock tomado"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+
+        wait = None
+        for chat_id, jobs in self._pending.items():
+            if chat_id in self._in_flight:
+                continue
+            chat_wait = self._chat_bucket(chat_id).peek()
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            global_wait = self.global_bucket.try_acquire()
+            if global_wait > 0:
+                return None, global_wait
+            self._chat_bucket(chat_id).try_acquire()
+            job = jobs.popleft()
+            if not jobs:
+                del self._pending[chat_id]
+            self._in_flight.add(chat_id)
+            return job, 0.0
+        return None, wait
+
+    def _requeue(self, job):
+        jobs = self._pending.get(job['chat_id'])
+        if jobs is None:
+            jobs = deque()
+            self._pending[job['chat_id']] = jobs
+            self._pending.move_to_end(job['chat_id'], last=False)
+        jobs.appendleft(job)
+
+    def _prune_buckets(self):
+        for chat_id in [c for c, b in self._chat_buckets.items()
+                        if c not in self._pending and c not in self._in_flight and b.is_full()]:
+            del self._chat_buckets[chat_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job, wait = self._next_job()
+                while job is None:
+                    self._condition.wait(wait)
+                    job, wait = self._next_job()
+
+            job = _resolve_message_id(job)
+            sent = time.monotonic()
+            result = self.bot.call(job['method'], job['data'], job['files'])
+            elapsed = time.monotonic() - job['enqueued']
+            if job['trace'] is not None:
+                # El span va desde que se encoló: incluye la espera por los límites de envío
+                job['trace'].add_span(f"telegram.{job['method']}", job['enqueued'], elapsed,
+                                      None if result and result.get('ok') else 'error',
+                                      wait_ms=round((sent - job['enqueued']) * 1000, 1))
+
+            with self._condition:
+                self._in_flight.discard(job['chat_id'])
+                if result and result.get('error_code') == 429:
+                    retry_after = (result.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f"Límite de Telegram alcanzado, reintentando en {retry_after}s")
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    self.throttled += 1
+                    self._requeue(job)
+                    self._condition.notify_all()
+                    continue
+
+                self._depth -= 1
+                if result and result.get('ok'):
+                    self.sent += 1
+                    self.latency_total += elapsed
+                    self.latency_max = max(self.latency_max, elapsed)
+                else:
+                    self.failed += 1
+                if len(self._chat_buckets) > 1000:
+                    self._prune_buckets()
+                self._condition.notify_all()
+
+            job['future'].set_result(result)
+
+class ProgressMessage:
+    """Respuesta de un comando lento: "🔄 ..." solo si tarda, y después se edita con el resultado
+
+    Si el resultado llega antes de PROGRESS_DELAY se envía un único mensaje.
+    """
+
+    def __init__(self, bot, chat_id, text, delay=PROGRESS_DELAY):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self._lock = threading.Lock()
+        self._placeholder = None
+        self._finished = False
+        # El temporizador corre en otro hilo: se le pasa la traza del comando
+        self._trace = tracing.current()
+        self._timer = threading.Timer(delay, self._send_placeholder)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _send_placeholder(self):
+        with self._lock, tracing.attach(self._trace):
+            if not self._finished:
+                self._placeholder = self.bot.send_message(self.chat_id, self.text)
+
+    def finish(self, text, reply_markup=None):
+        """Enviar el resultado, editando el mensaje de progreso si ya se mostró"""
+        self._timer.cancel()
+        with self._lock:
+            self._finished = True
+            placeholder = self._placeholder
+        if placeholder is None:
+            return self.bot.send_message(self.chat_id, text, reply_markup)
+        return self.bot.edit_message_text(self.chat_id, placeholder, text, reply_markup)
+
 class TelegramBot:
     def __init__(self, token):
         self.token = token
         self.api_url = f"https://api.telegram.org/bot{token}"
         self.offset = 0
-    
+        # Sesiones separadas para el long polling y para los envíos (conexiones persistentes)
+        self.session = requests.Session()
+        self.poll_session = requests.Session()
+        self.outbox = OutboundQueue(self)
+        metrics.TELEGRAM_QUEUE_DEPTH.set_function(self.outbox.depth)
+
+    def call(self, method, data, files=None):
+        """Llamar a un método de la API de Telegram de forma síncrona"""
+        try:
+            with metrics.TELEGRAM_REQUEST_DURATION.time(method=method):
+                response = self.session.post(f"{self.api_url}/{method}", data=data, files=files,
+                                             timeout=REQUEST_TIMEOUT)
+            return response.json()
+        except Exception as e:
+            logger.error(f"Error llamando a {method}: {e}")
+            return None
+
     def send_message(self, chat_id, text, reply_markup=None):
-        """Enviar mensaje usando requests"""
-        url = f"{self.api_url}/sendMessage"
+        """Encolar un mensaje; devuelve un Future con la respuesta de Telegram"""
         data = {
             'chat_id': chat_id,
             'text': text,
@@ -20,24 +254,68 @@ class TelegramBot:
         }
         if reply_markup:
             data['reply_markup'] = json.dumps(reply_markup)
-        
-        try:
-            response = requests.post(url, data=data)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error enviando mensaje: {e}")
-            return None
-    
-    def get_updates(self):
-        """Obtener actualizaciones usando requests"""
+
+        return self.outbox.submit('sendMessage', chat_id, data)
+
+    def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        """Encolar la edición de un mensaje; message_id puede ser el Future de send_message"""
+        data = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'parse_mode': 'HTML'
+        }
+        if reply_markup:
+            data['reply_markup'] = json.dumps(reply_markup)
+
+        return self.outbox.submit('editMessageText', chat_id, data)
+
+    def send_document(self, chat_id, filename, content, caption=None):
+        """Encolar el envío de un archivo (content en bytes)"""
+        data = {'chat_id': chat_id}
+        if caption:
+            data['caption'] = caption
+
+        return self.outbox.submit('sendDocument', chat_id, data, files={'document': (filename, content)})
+
+    def answer_callback_query(self, chat_id, callback_query_id, text=None):
+        """Confirmar la pulsación de un botón inline (se encola en el orden del chat)"""
+        data = {'callback_query_id': callback_query_id}
+        if text:
+            data['text'] = text
+
+        return self.outbox.submit('answerCallbackQuery', chat_id, data)
+
+    def progress(self, chat_id, text):
+        """Mensaje de progreso para un comando lento (ver ProgressMessage)"""
+        return ProgressMessage(self, chat_id, text)
+
+    def set_webhook(self, url, secret_token, drop_pending_updates=False):
+        """Registrar el webhook; Telegram enviará cada update a `url` con el token en la cabecera"""
+        result = self.call('setWebhook', {
+            'url': url,
+            'secret_token': secret_token,
+            'drop_pending_updates': drop_pending_updates,
+            'allowed_updates': json.dumps(['message', 'edited_message', 'callback_query'])
+        })
+        return bool(result and result.get('ok'))
+
+    def delete_webhook(self):
+        """Quitar el webhook para poder usar getUpdates"""
+        result = self.call('deleteWebhook', {})
+        return bool(result and result.get('ok'))
+
+    def get_updates(self, timeout=POLL_TIMEOUT):
+        """Obtener actualizaciones usando requests (long polling de `timeout` segundos)"""
         url = f"{self.api_url}/getUpdates"
         params = {
             'offset': self.offset,
-            'timeout': 30
+            'timeout': timeout
         }
-        
+
         try:
-            response = requests.get(url, params=params)
+            with metrics.TELEGRAM_REQUEST_DURATION.time(method='getUpdates'):
+                response = self.poll_session.get(url, params=params, timeout=timeout + REQUEST_TIMEOUT)
             return response.json()
         except Exception as e:
             logger.error(f"Error obteniendo actualizaciones: {e}")
@@ -0,0 +1,138 @@
+import os
+import time
+import itertools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# Trazas recientes que se conservan en memoria (0 = trazado desactivado)
+BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER', 1000))
+# Spans que se guardan como máximo por traza; los siguientes solo se cuentan
+MAX_SPANS = 100
+
+_current = contextvars.ContextVar('trace', default=None)
+_ids = itertools.count(1)
+_buffer = deque(maxlen=BUFFER_SIZE or 1)
+_lock = threading.Lock()
+
+class Trace:
+    """Traza de un update: datos del update y spans con sus tiempos relativos al inicio"""
+
+    __slots__ = ('id', 'name', 'attrs', 'started', 'start', 'duration', 'spans', 'dropped', 'error')
+
+    def __init__(self, name, start=None, **attrs):
+        self.id = next(_ids)
+        self.name = name
+        self.attrs = attrs
+        # Hora de pared para filtrar por antigüedad y monotónica para medir
+        self.start = start if start is not None else time.monotonic()
+        self.started = time.time() - (time.monotonic() - self.start)
+        self.duration = None
+        self.spans = []
+        self.dropped = 0
+        self.error = None
+
+    def add_span(self, name, start, duration, error=None, **attrs):
+        # list.append es atómico: los spans pueden llegar desde los hilos de envío
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((name, start - self.start, duration, error, attrs))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'started': self.started,
+            'duration_ms': None if self.duration is None else round(self.duration * 1000, 1),
+            'error': self.error,
+            **self.attrs,
+            'spans': [
+                {'name': name, 'offset_ms': round(offset * 1000, 1), 'duration_ms': round(duration * 1000, 1),
+                 **({'error': error} if error else {}), **attrs}
+                for name, offset, duration, error, attrs in list(self.spans)
+            ],
+            'dropped_spans': self.dropped
+        }
+
+def current():
+    """Traza activa en este contexto (None si no hay)"""
+    return _current.get()
+
+@contextmanager
+def trace(name, start=None, **attrs):
+    """Abrir una traza nueva; al terminar se guarda en el buffer circular
+
+    `start` (time.monotonic) permite que la traza empiece antes, p. ej. al recibir el update.
+    """
+    if not BUFFER_SIZE:
+        yield None
+        return
+    current_trace = Trace(name, start, **attrs)
+    token = _current.set(current_trace)
+    try:
+        yield current_trace
+    except Exception as e:
+        current_trace.error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        current_trace.duration = time.monotonic() - current_trace.start
+        with _lock:
+            _buffer.append(current_trace)
+
+@contextmanager
+def attach(current_trace):
+    """Continuar una traza en otro hilo (los hilos no heredan el contexto)"""
+    token = _current.set(current_trace)
+    try:
+        yield current_trace
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name, **attrs):
+    """Medir un bloque dentro de la traza activa; sin traza no hace nada"""
+    current_trace = _current.get()
+    if current_trace is None:
+        yield
+        return
+    start = time.monotonic()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        current_trace.add_span(name, start, time.monotonic() - start, error, **attrs)
+
+def tag(**attrs):
+    """Añadir datos a la traza activa (p. ej. el comando, conocido al despachar)"""
+    current_trace = _current.get()
+    if current_trace is not None:
+        current_trace.attrs.update(attrs)
+
+def traces(min_duration=None, since=None, slowest=False, limit=50, **attrs):
+    """Trazas del buffer filtradas, de la más reciente a la más antigua (o de la más lenta)
+
+    `since` son segundos hacia atrás; `attrs` filtra por igualdad (user_id, update_id, ...).
+    """
+    with _lock:
+        items = list(_buffer) if BUFFER_SIZE else []
+    now = time.time()
+    selected = []
+    for item in reversed(items):
+        if item.duration is None:
+            continue
+        if min_duration is not None and item.duration < min_duration:
+            continue
+        if since is not None and now - item.started > since:
+            continue
+        if any(str(item.attrs.get(key)) != str(value) for key, value in attrs.items()):
+            continue
+        selected.append(item)
+    if slowest:
+        selected.sort(key=lambda item: item.duration, reverse=True)
+    return [item.to_dict() for item in selected[:limit]]
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import logging
+import storage
+from coordination import INSTANCE_ID
+
+logger = logging.getLogger(__name__)
+
+# Los comandos más antiguos que esto (p. ej. enviados durante un reinicio largo) se descartan
+MAX_AGE = float(os.environ.get('UPDATE_MAX_AGE', 900))
+
+# Segundos sin renovarse tras los que los updates en curso de una instancia se dan por
+# abandonados (proceso caído) y otra instancia los reserva
+CLAIM_TTL = float(os.environ.get('UPDATE_CLAIM_TTL', 30))
+
+OFFSET_KEY = 'telegram_offset'
+
+def update_date(update):
+    """Fecha (epoch) en que el usuario envió el mensaje; None si el update no la tiene"""
+    for kind in ('message', 'edited_message'):
+        if kind in update:
+            return update[kind].get('date')
+    return None
+
+def is_stale(update, now=None, max_age=MAX_AGE):
+    date = update_date(update)
+    return bool(max_age) and date is not None and (now or time.time()) - date > max_age
+
+def load_offset():
+    """Offset de getUpdates guardado en el último lote (0 si no hay)"""
+    return storage.get_store().get_meta(OFFSET_KEY, 0)
+
+def record(updates, offset=None):
+    """Guardar y reservar para esta instancia los updates recibidos (y el nuevo offset) antes de procesarlos
+
+    Así los que no se terminen de procesar se recuperan tras un reinicio, aunque
+    Telegram ya los haya dado por entregados. Devuelve los updates reservados: uno que
+    otra instancia ya tiene en curso (reserva sin caducar) no se devuelve.
+    """
+    now = time.time()
+    statements = [('INSERT INTO pending_updates (update_id, payload, received, claimed_by, claimed_at) '
+                   'VALUES (?, ?, ?, ?, ?) ON CONFLICT(update_id) DO UPDATE SET '
+                   'claimed_by = excluded.claimed_by, claimed_at = excluded.claimed_at '
+                   'WHERE pending_updates.claimed_at < ? RETURNING update_id',
+                   (update['update_id'], json.dumps(update), now, INSTANCE_ID, now, now - CLAIM_TTL))
+                  for update in updates]
+    if offset is not None:
+        statements.append(('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                           (OFFSET_KEY, json.dumps(offset))))
+    if not statements:
+        return []
+    results = storage.get_store().transaction(statements)
+    claimed = {update_id for rows in results[:len(updates)] for update_id, in rows}
+    return [update for update in updates if update['update_id'] in claimed]
+
+def done(update_id):
+    storage.get_store().execute('DELETE FROM pending_updates WHERE update_id = ?', (update_id,))
+
+def renew():
+    """Renovar la reserva de los updates que esta instancia tiene en curso"""
+    storage.get_store().execute('UPDATE pending_updates SET claimed_at = ? WHERE claimed_by = ?',
+                                (time.time(), INSTANCE_ID))
+
+def claim_abandoned():
+    """Reservar los updates sin terminar de instancias que dejaron de renovarlos, en orden
+
+    Incluye los del proceso anterior tras un reinicio (el identificador de instancia cambia).
+    """
+    now = time.time()
+    rows = storage.get_store().execute(
+        'UPDATE pending_updates SET claimed_by = ?, claimed_at = ? WHERE claimed_at < ? '
+        'RETURNING update_id, payload', (INSTANCE_ID, now, now - CLAIM_TTL)
+    )
+    return [json.loads(payload) for _, payload in sorted(rows)]
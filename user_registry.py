@@ -0,0 +1,126 @@
+import threading
+
+class UserRegistry(dict):
+    """Configuraciones de usuario (user_id -> config) con índices por username y por (url, db)
+
+    Es un dict normal para el resto del código. Los cambios dentro de una configuración
+    (config['username'] = ...) no pasan por el dict, así que hay que llamar a reindex()
+    después; save_persistent_data lo hace para los usuarios que guarda.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._by_username = {}
+        self._by_database = {}
+        # user_id -> claves con las que está indexado, para poder desindexarlo sin la config anterior
+        self._keys = {}
+        self._sorted = None
+        self.update(*args, **kwargs)
+
+    @staticmethod
+    def _index_keys(config):
+        config = config or {}
+        username = config.get('username')
+        database = (config['url'], config['db']) if 'url' in config and 'db' in config else None
+        return username, database
+
+    def _unindex(self, user_id):
+        username, database = self._keys.pop(user_id, (None, None))
+        for index, key in ((self._by_username, username), (self._by_database, database)):
+            if key is None:
+                continue
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del index[key]
+
+    def _index(self, user_id, config):
+        username, database = self._index_keys(config)
+        if username is not None:
+            self._by_username.setdefault(username, set()).add(user_id)
+        if database is not None:
+            self._by_database.setdefault(database, set()).add(user_id)
+        self._keys[user_id] = (username, database)
+
+    def reindex(self, user_id):
+        """Actualizar los índices de un usuario tras modificar su configuración"""
+        with self._lock:
+            self._unindex(user_id)
+            if user_id in self:
+                self._index(user_id, self[user_id])
+
+    def __setitem__(self, user_id, config):
+        with self._lock:
+            if user_id not in self:
+                self._sorted = None
+            super().__setitem__(user_id, config)
+            self._unindex(user_id)
+            self._index(user_id, config)
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            super().__delitem__(user_id)
+            self._unindex(user_id)
+            self._sorted = None
+
+    def pop(self, user_id, *default):
+        with self._lock:
+            if user_id not in self:
+                return super().pop(user_id, *default)
+            config = super().pop(user_id)
+            self._unindex(user_id)
+            self._sorted = None
+            return config
+
+    def popitem(self):
+        with self._lock:
+            user_id, config = super().popitem()
+            self._unindex(user_id)
+            self._sorted = None
+            return user_id, config
+
+    def setdefault(self, user_id, default=None):
+        with self._lock:
+            if user_id not in self:
+                self[user_id] = default
+            return self[user_id]
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            for user_id, config in dict(*args, **kwargs).items():
+                self[user_id] = config
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._by_username.clear()
+            self._by_database.clear()
+            self._keys.clear()
+            self._sorted = None
+
+    def find_by_username(self, username):
+        """IDs de los usuarios con ese username de Odoo, ordenados"""
+        with self._lock:
+            return sorted(self._by_username.get(username, ()))
+
+    def find_by_database(self, url, db):
+        """IDs de los usuarios de una base de datos de Odoo, ordenados"""
+        with self._lock:
+            return sorted(self._by_database.get((url, db), ()))
+
+    def databases(self):
+        """(url, db) de todas las bases de datos con usuarios"""
+        with self._lock:
+            return list(self._by_database)
+
+    def page(self, number, size):
+        """Página `number` (desde 0) de (user_id, config) ordenados por user_id y número de páginas"""
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self)
+            pages = max(1, -(-len(self._sorted) // size))
+            number = min(max(number, 0), pages - 1)
+            ids = self._sorted[number * size:(number + 1) * size]
+            return [(user_id, self[user_id]) for user_id in ids], number, pages
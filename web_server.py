@@ -1,26 +1,139 @@
 import os
+import hmac
 import logging
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
+import metrics
+import tracing
+import profiler
+import circuit_breaker
 
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# Token para los endpoints de depuración (/debug/...); sin él quedan desactivados
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
+# Token para /metrics (incluye IDs de usuarios de Telegram); sin él el endpoint queda desactivado
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Secreto del webhook de Telegram y función que recibe cada update (None = modo polling)
+_webhook_secret = None
+_update_handler = None
+
+def set_update_handler(secret, handler):
+    """Activar la ruta del webhook: los updates con el secreto correcto se pasan a `handler`"""
+    global _webhook_secret, _update_handler
+    _webhook_secret = secret
+    _update_handler = handler
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Endpoint de health check para keep-alive"""
     return jsonify({
         'status': 'ok',
         'message': 'Bot is running',
-        'service': 'telegram-odoo-bot'
+        'service': 'telegram-odoo-bot',
+        'odoo_hosts': circuit_breaker.states()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas en formato Prometheus"""
+    if not _token_authorized(METRICS_TOKEN):
+        return jsonify({'ok': False}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/telegram/<secret>', methods=['POST'])
+def telegram_webhook(secret):
+    """Recibir updates de Telegram (modo webhook)"""
+    if _update_handler is None or not hmac.compare_digest(secret, _webhook_secret):
+        return jsonify({'ok': False}), 404
+    header = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(header, _webhook_secret):
+        logger.warning("Update de webhook rechazado: token secreto incorrecto")
+        return jsonify({'ok': False}), 403
+
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or 'update_id' not in update:
+        return jsonify({'ok': False}), 400
+    if not _update_handler(update):
+        # El bucle de updates aún no arrancó: Telegram reintentará más tarde
+        return jsonify({'ok': False}), 503
+    return jsonify({'ok': True}), 200
+
+def _token_authorized(expected):
+    """Comprobar un token (cabecera Authorization: Bearer o parámetro token); sin token configurado, no"""
+    if not expected:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else request.args.get('token', '')
+    return hmac.compare_digest(token, expected)
+
+def _debug_authorized():
+    return _token_authorized(DEBUG_TOKEN)
+
+@app.route('/debug/traces', methods=['GET'])
+def debug_traces():
+    """Trazas recientes de updates
+
+    Filtros: user_id, update_id, command, min_ms, since (segundos), limit. Con
+    slowest=1 se ordenan por duración, por defecto sobre la última hora.
+    """
+    if not _debug_authorized():
+        return jsonify({'ok': False}), 404
+    args = request.args
+    try:
+        slowest = args.get('slowest', '') in ('1', 'true', 'yes')
+        since = float(args['since']) if 'since' in args else (3600 if slowest else None)
+        min_duration = float(args['min_ms']) / 1000 if 'min_ms' in args else None
+        limit = min(int(args.get('limit', 50)), tracing.BUFFER_SIZE or 1)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Parámetro inválido'}), 400
+    filters = {key: args[key] for key in ('user_id', 'update_id', 'command') if key in args}
+    result = tracing.traces(min_duration=min_duration, since=since, slowest=slowest, limit=limit, **filters)
+    return jsonify({'ok': True, 'count': len(result), 'traces': result}), 200
+
+@app.route('/debug/profile', methods=['POST'])
+def debug_profile():
+    """Muestrear los hilos durante `seconds` (target: bot, scheduler o all) y devolver las pilas collapsed"""
+    if not _debug_authorized():
+        return jsonify({'ok': False}), 404
+    target = request.args.get('target', 'all')
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        collapsed = profiler.sample(seconds, target)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    except profiler.ProfilerBusy as e:
+        return jsonify({'ok': False, 'error': str(e)}), 409
+    return Response(collapsed, mimetype='text/plain; charset=utf-8')
+
+@app.route('/debug/profile/<action>', methods=['GET', 'POST'])
+def debug_profile_run(action):
+    """POST: perfilar la próxima ejecución programada de `action`. GET: último perfil (format=pstats|text)"""
+    if not _debug_authorized():
+        return jsonify({'ok': False}), 404
+    if action not in ('check_in', 'check_out'):
+        return jsonify({'ok': False, 'error': 'Acción desconocida'}), 400
+    if request.method == 'POST':
+        profiler.arm(action)
+        return jsonify({'ok': True, 'armed': action}), 202
+
+    result = profiler.last_result(action)
+    if result is None:
+        return jsonify({'ok': False, 'error': 'Aún no hay perfil'}), 404
+    if request.args.get('format') == 'pstats':
+        return Response(result['pstats'], mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename={action}.pstats'})
+    return jsonify({'ok': True, 'summary': result['summary'], 'finished': result['finished'],
+                    'top': result['text']}), 200
+
 @app.route('/', methods=['GET'])
 def root():
     """Endpoint raíz"""
     return jsonify({
         'message': 'Telegram Odoo Bot is running',
-        'endpoints': ['/health']
+        'endpoints': ['/health', '/metrics']
     }), 200
 
 def run_web_server():